@@ -2,16 +2,11 @@ from lottery import *
 import gradio as gr
 
 
-l = Lottery()
+l = Lottery(orientation=True)
 def demo(img):
     res = ""
     try:
-        for i in range(4):
-            res = l(img)
-            if not res:
-                img = np.rot90(img, k=3)
-            else:
-                break
+        res = l(img)
         if not res:
             raise MissingInfoException("没有检测到彩票信息，请调整图片后重试。")
         res =  str(Result.fromTuple(res))
@@ -1,9 +1,130 @@
-import requests
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 
+import requests
+from requests.adapters import HTTPAdapter
+
+from draws import DrawIndex
+from prize import prize_check
 from utils import *
 
 
+class NotDrawnException(requests.RequestException):
+    def __init__(self, *args):
+        super().__init__(*args)
+
+
+class DrawCache:
+    '''
+    开奖号码缓存：sqlite中持久保存已开奖的号码（永不过期）和“尚未开奖”的查询结果（negative_ttl秒后过期），
+    内存中再加一层容量为lru_size的LRU。filename为None时只使用内存LRU。
+    '''
+    def __init__(
+        self,
+        filename = None,
+        negative_ttl = 300,
+        lru_size = 256
+    ):
+        self.filename = filename
+        self.negative_ttl = negative_ttl
+        self.lru_size = lru_size
+        self.lru = OrderedDict()    # (code, issue) -> 开奖号码，或“尚未开奖”的过期时间
+        self.lock = threading.Lock()
+
+        self.db = None
+        if filename is not None:
+            Path(filename).parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(str(filename), timeout=30, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")     # 多个worker进程共享同一个缓存文件
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS draws ("
+                "code TEXT NOT NULL, issue TEXT NOT NULL, red TEXT, blue TEXT, expires REAL, "
+                "PRIMARY KEY (code, issue))"
+            )
+            self.db.commit()
+
+    def remember(
+        self,
+        key,
+        value
+    ):
+        self.lru[key] = value
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
+    def get(
+        self,
+        code,
+        issue
+    ):
+        '''
+        返回开奖号码(red, blue)；在有效期内的“尚未开奖”记录返回False；没有记录返回None。
+        '''
+        key = (code, issue)
+        now = time.time()
+        with self.lock:
+            value = self.lru.get(key, None)
+            if value is None and self.db is not None:
+                row = self.db.execute(
+                    "SELECT red, blue, expires FROM draws WHERE code = ? AND issue = ?", key
+                ).fetchone()
+                if row is not None:
+                    red, blue, expires = row
+                    value = expires if expires is not None else (red.split(), blue.split())
+            if value is None:
+                return
+            if isinstance(value, float):
+                if value < now:
+                    self.lru.pop(key, None)
+                    return
+                self.remember(key, value)
+                return False
+            self.remember(key, value)
+            return value
+
+    def put(
+        self,
+        code,
+        issue,
+        winning
+    ):
+        key = (code, issue)
+        red, blue = winning
+        with self.lock:
+            self.remember(key, winning)
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO draws VALUES (?, ?, ?, ?, NULL)", (code, issue, " ".join(red), " ".join(blue))
+                )
+                self.db.commit()
+
+    def put_missing(
+        self,
+        code,
+        issue
+    ):
+        key = (code, issue)
+        expires = time.time() + self.negative_ttl
+        with self.lock:
+            self.remember(key, expires)
+            if self.db is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO draws VALUES (?, ?, NULL, NULL, ?)", (code, issue, expires)
+                )
+                self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            if self.db is not None:
+                return self.db.execute("SELECT COUNT(*) FROM draws WHERE expires IS NULL").fetchone()[0]
+            return sum(not isinstance(v, float) for v in self.lru.values())
+
+
 class Checker:
 
     def __init__(
@@ -11,7 +132,14 @@ class Checker:
         url, 
         app_id, 
         app_secret, 
-        timeout = 5
+        timeout = 5,
+        retries = 2,
+        backoff = 0.5,
+        pool_size = 8,
+        cache = None,
+        negative_ttl = 300,
+        lru_size = 256,
+        index_dir = None
     ):
         
         self.url = url
@@ -20,13 +148,30 @@ class Checker:
             "app_secret" : app_secret
         }
         self.timeout = timeout
-        self.saved = {}
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.saved = DrawCache(cache, negative_ttl, lru_size)
+        self.index_dir = index_dir
+        self.indexes = {}
+
+        # 复用连接，避免每次查询都重新建立tcp/tls连接
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # 正在进行中的查询，同一期的并发查询只发出一次请求
+        self.lock = threading.Lock()
+        self.inflight = {}
     
     @classmethod
     def from_file(
         self, 
         filename, 
-        timeout=5
+        timeout=5,
+        **kwargs
     ):
         p = Path(filename)
         if not p.is_file():
@@ -37,31 +182,128 @@ class Checker:
         if len(contents) < 3:
             raise MissingInfoException(f"File {p} is not complete.")
         url, app_id, app_secret = [l.strip() for l in contents]
-        return Checker(url, app_id, app_secret, timeout)
+        return Checker(url, app_id, app_secret, timeout, **kwargs)
+
+    def index(
+        self,
+        code
+    ):
+        '''
+        返回离线导入的开奖号码索引（见draws.py），没有时返回None。
+        '''
+        if code not in self.indexes:
+            p = None if self.index_dir is None else Path(self.index_dir) / f"{code}.npz"
+            self.indexes[code] = DrawIndex.load(p) if p is not None and p.is_file() else None
+        return self.indexes[code]
+
+    def get(
+        self,
+        payload
+    ):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))  # 指数退避
+            try:
+                r = self.session.get(self.url, params=payload, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+                continue
+            if r.status_code == requests.codes.ok:
+                return r
+            error = requests.RequestException(f"网络请求出错，code: {r.status_code}，请检查网络连接。")
+            if r.status_code != requests.codes.too_many_requests and r.status_code < 500:
+                break   # 非临时性错误，重试没有意义
+        raise error
+
+    def fetch(
+        self,
+        code,
+        issue
+    ):
+        payload = {
+            "code" : code,
+            "expect" : issue
+        }
+        r = self.get(payload)
+        js = r.json()
+        if js["code"] != 1:
+            raise NotDrawnException(f"没有查询到期号为{issue}的彩票开奖信息，请确认是否已开奖。")
+        winning = js["data"]["openCode"]
+        if not winning:
+            raise MissingInfoException("接口返回数据中未解析到开奖号码。")
+        return winning_process(winning, code)
 
     def query(
         self, 
         code, 
         issue
     ):
-        winning = self.saved.get((code, issue), None)
-        if not winning:
-            payload = {
-                "code" : code,
-                "expect" : issue
-            }
-            r = requests.get(self.url, params=payload, headers=self.headers, timeout=self.timeout)
-            if  r.status_code != requests.codes.ok:
-                raise requests.RequestException(f"网络请求出错，code: {r.status_code}，请检查网络连接。")
-            js = r.json()
-            if js["code"] != 1:
-                raise requests.RequestException(f"没有查询到期号为{issue}的彩票开奖信息，请确认是否已开奖。")
-            winning = js["data"]["openCode"]
-            if not winning:
-                raise MissingInfoException("接口返回数据中未解析到开奖号码。")
-            winning = winning_process(winning, code)
-            self.saved[(code, issue)] = winning
+        if issue is None:
+            raise MissingInfoException("没有识别到期号，请调整图片后重试。")
+
+        key = (code, issue)
+        index = self.index(code)
+        if index is not None and issue.isdigit():
+            winning = index.get(issue)  # 比索引更新的期号才需要联网查询
+            if winning:
+                return winning
+
+        winning = self.saved.get(code, issue)
+        if winning is False:
+            raise NotDrawnException(f"没有查询到期号为{issue}的彩票开奖信息，请确认是否已开奖。")
+        if winning:
+            return winning
+
+        with self.lock:
+            winning = self.saved.get(code, issue)
+            if winning:
+                return winning
+            future = self.inflight.get(key, None)
+            leader = future is None
+            if leader:
+                future = self.inflight[key] = Future()
+
+        if not leader:
+            return future.result()  # 等待同一期正在进行的查询
+
+        try:
+            winning = self.fetch(code, issue)
+            self.saved.put(code, issue, winning)
+            future.set_result(winning)
+        except NotDrawnException as e:
+            self.saved.put_missing(code, issue)
+            future.set_exception(e)
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
         return winning
+
+    def query_many(
+        self,
+        keys
+    ):
+        '''
+        并行查询多个(code, issue)，返回dict，查询失败的值为对应的异常。
+        '''
+        keys = list(set(keys))
+        results = {}
+        if not keys:
+            return results
+
+        def query(key):
+            try:
+                return self.query(*key)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(min(self.pool_size, len(keys))) as executor:
+            for key, winning in zip(keys, executor.map(query, keys)):
+                results[key] = winning
+        return results
     
     def __call__(
         self, 
@@ -73,3 +315,16 @@ class Checker:
         hits = hit_check(numbers, winning)
         return hits, winning
 
+    def prizes(
+        self,
+        code,
+        issue,
+        numbers,
+        prizes = None
+    ):
+        '''
+        返回每行号码各奖级的中奖注数、奖金，以及开奖号码。
+        '''
+        winning = self.query(code, issue)
+        counts, amounts = prize_check(numbers, winning, prizes)
+        return counts, amounts, winning
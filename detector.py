@@ -1,62 +1,372 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+from contextlib import redirect_stdout
+from pathlib import Path
+
 import numpy as np
 import torch
+import torch.nn as nn
+import torch.nn.functional as F
 
 from models.yolo.utils.datasets import letterbox
-from models.yolo.utils.general import check_img_size, non_max_suppression, scale_coords
+from models.yolo.utils.general import check_img_size, make_divisible, fast_non_max_suppression, scale_coords
 from models.yolo.utils.torch_utils import select_device
 from models.yolo.model import Model
 from models.yolo.experimental import attempt_load
 
 
+TTA_MODES = ("none", "full-tta", "adaptive")
+BACKENDS = ("torch", "onnxruntime")
+CLASSES = (0, 1, 2, 3)  # 双色球、号码、大乐透、期号
+REQUIRED = ((0, 2), (1,), (3,))     # 彩票类型、号码、期号都需要被检出
+
+log = logging.getLogger(__name__)
+
+
+def file_hash(
+    filename,
+    chunk_size = 1 << 20
+):
+    '''
+    计算模型文件的sha256，用于标识融合后模型的缓存。
+    '''
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_fused(
+    model_file,
+    map_location = None,
+    cache_dir = None
+):
+    '''
+    加载推理用的融合模型：Conv+BN、RepConv、IDetect的隐式层均被融合，激活函数改为inplace。
+    融合结果按原始模型文件的hash缓存到cache_dir，之后启动时直接加载缓存。
+    '''
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = Path(cache_dir) / f"{Path(model_file).stem}.fused.{file_hash(model_file)[:16]}.pt"
+        if cache_file.is_file():
+            return torch.load(cache_file, map_location)["model"]
+
+    ckpt = torch.load(model_file, map_location)
+    model = ckpt["ema" if ckpt.get("ema") else "model"].float()
+    with torch.no_grad(), redirect_stdout(sys.stderr):    # fuse会print，不能混进stdout的jsonl结果
+        model.fuse()    # IDetect.forward is switched to fuseforward here
+    model.eval()
+
+    for m in model.modules():
+        if type(m) in [nn.Hardswish, nn.LeakyReLU, nn.ReLU, nn.ReLU6, nn.SiLU]:
+            m.inplace = True
+        elif type(m) is nn.Upsample:
+            m.recompute_scale_factor = None  # torch 1.11.0 compatibility
+
+    if cache_file is not None:
+        tmp = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            torch.save({"model": model}, tmp)
+            os.replace(tmp, cache_file)     # 多个进程同时启动时避免读到写了一半的缓存
+        except OSError as e:
+            log.warning("Cannot write fused model cache %s: %s", cache_file, e)    # 缓存写不了不影响推理
+            tmp.unlink(missing_ok=True)
+
+    return model
+
+
 class Detector:
 
     def __init__(
         self,
         model_file,
-        conf_thres = 0.25, 
-        iou_thres = 0.45, 
-        device = "cpu"
+        conf_thres = 0.25,
+        iou_thres = 0.45,
+        device = "cpu",
+        tta = "full-tta",
+        adaptive_conf = 0.5,
+        fuse = True,
+        cache_dir = None,
+        backend = "torch",
+        buckets = None,
+        device_preprocess = False,
+        max_per_class = None
     ):
+        assert tta in TTA_MODES, f"TTA mode {tta} is illegal."
+        assert backend in BACKENDS, f"Backend {backend} is illegal."
+        self.backend = backend
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.tta = tta
+        self.adaptive_conf = adaptive_conf
+        self.max_per_class = max_per_class
+        self.input_shape = None     # onnx模型的输入尺寸是固定的
+        self.buckets = None
+        self.device_preprocess = device_preprocess and backend == "torch"
+        # 复用的pinned内存(pinned)和按尺寸复用的输入tensor(inputs)，每个线程各有一份，
+        # 多个线程共用一个Detector时(run.py、web demo)不会互相覆盖
+        self.local = threading.local()
+
+        if backend == "onnxruntime":
+            self.init_onnxruntime(model_file)
+            if buckets:
+                log.warning(f"Shape buckets are ignored by onnxruntime backend, using {self.input_shape} instead.")
+            return
+
         self.device = select_device(device)
-        weights = torch.load(model_file, self.device)
-        self.model = weights["model"]
+        if fuse:
+            if cache_dir is None:
+                cache_dir = Path(model_file).parent / ".cache"
+            self.model = load_fused(model_file, self.device, cache_dir)
+        else:
+            weights = torch.load(model_file, self.device)
+            self.model = weights["model"]
         self.stride = int(self.model.stride.max())
         self.imgsz = check_img_size(640, s=self.stride)
 
-        self.conf_thres = conf_thres
-        self.iou_thres = iou_thres
-        
         self.half = device != "cpu"
         if self.half:
             self.model.half()
         self.model.eval()
 
-    def __call__(
-        self, 
-        img
+        if buckets:
+            self.buckets = [tuple(make_divisible(x, self.stride) for x in shape) for shape in buckets]
+            self.warmup()
+
+    def warmup(self):
+        '''
+        对每个尺寸做一次空推理，提前生成检测层在各尺寸（包括TTA的缩放尺寸）下的grid。
+        '''
+        for shape in self.buckets:
+            x = self.to_tensor(np.zeros((3, *shape), dtype=np.uint8))
+            self.inference(x)
+            if self.tta != "none":
+                self.inference(x, augment=True)
+
+    def bucket(
+        self,
+        shape
+    ):
+        '''
+        返回letterbox后padding面积占比最小的尺寸，即与图片长宽比最接近的尺寸。没有设置buckets时返回None。
+        '''
+        if not self.buckets:
+            return
+        h, w = shape[:2]
+
+        def waste(bucket):
+            r = min(bucket[0] / h, bucket[1] / w)
+            return 1 - h * w * r * r / (bucket[0] * bucket[1])
+
+        return min(self.buckets, key=waste)
+
+    def init_onnxruntime(
+        self,
+        model_file
+    ):
+        # 由export.py导出，NMS已经包含在计算图中，输出为[batch序号, x1, y1, x2, y2, 类别, 置信度]
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(str(model_file), options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.input_shape = tuple(self.session.get_inputs()[0].shape[2:])
+        self.stride = 32
+        self.imgsz = max(self.input_shape)
+        self.device = torch.device("cpu")
+        self.half = False
+
+        if self.tta != "none":
+            log.warning(f"TTA mode {self.tta} is not supported by onnxruntime backend, using single pass instead.")
+            self.tta = "none"
+
+        # NMS包含在计算图中，阈值在导出时已经固定，运行时传入的阈值不起作用
+        meta = self.session.get_modelmeta().custom_metadata_map
+        for name in ("conf_thres", "iou_thres"):
+            if name not in meta:
+                log.warning(f"{name} of {model_file} is fixed at export time and unknown, {getattr(self, name)} is ignored.")
+                continue
+            exported = json.loads(meta[name])
+            if abs(exported - getattr(self, name)) > 1e-6:
+                log.warning(f"{name} {getattr(self, name)} is ignored by onnxruntime backend, using {exported} fixed at export time.")
+            setattr(self, name, exported)
+
+    def resize(
+        self,
+        img,
+        new_shape = None
     ):
-        shape = img.shape
-        img = letterbox(img, self.imgsz, stride=self.stride)[0]   # resize & padding
+        # 只在cpu上操作，可以放在加载线程中提前完成
+        if new_shape is None:
+            new_shape = self.input_shape or self.bucket(img.shape)
+        if new_shape is None:
+            img = letterbox(img, self.imgsz, stride=self.stride)[0]   # resize & padding
+        else:
+            img = letterbox(img, new_shape=new_shape, auto=False)[0]
         img = img[:, :, ::-1].transpose(2, 0, 1)    # hwc(bgr) -> hwc(rgb) -> c(rgb)hw
-        img = np.ascontiguousarray(img)
+        return np.ascontiguousarray(img)
+
+    def letterbox_shape(
+        self,
+        shape,
+        new_shape,
+        auto = True
+    ):
+        '''
+        与letterbox相同的尺寸计算，返回输出尺寸、缩放后的尺寸和左上角的padding。
+        '''
+        if isinstance(new_shape, int):
+            new_shape = (new_shape, new_shape)
+        r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
+        unpad = int(round(shape[0] * r)), int(round(shape[1] * r))
+        dh, dw = new_shape[0] - unpad[0], new_shape[1] - unpad[1]
+        if auto:
+            dh, dw = dh % self.stride, dw % self.stride
+        top, left = int(round(dh / 2 - 0.1)), int(round(dw / 2 - 0.1))
+        return (unpad[0] + dh, unpad[1] + dw), unpad, (top, left)
+
+    def upload(
+        self,
+        imgs
+    ):
+        '''
+        把uint8的原图上传到device。cuda上先拷贝到复用的pinned内存再异步上传，cpu上直接共享numpy的内存。
+        '''
+        if self.device.type == "cpu":
+            return [torch.from_numpy(np.ascontiguousarray(img)) for img in imgs]
+
+        total = sum(img.size for img in imgs)
+        pinned = getattr(self.local, "pinned", None)
+        if pinned is None or pinned.numel() < total:
+            pinned = self.local.pinned = torch.empty(total, dtype=torch.uint8).pin_memory()
+        tensors, offset = [], 0
+        for img in imgs:
+            buffer = pinned[offset : offset + img.size].view(img.shape)
+            buffer.numpy()[...] = img     # 兼容负stride的view，例如imread返回的img[:, :, ::-1]
+            tensors.append(buffer.to(self.device, non_blocking=True))
+            offset += img.size
+        return tensors
+
+    def device_letterbox(
+        self,
+        imgs,
+        new_shape,
+        auto = True
+    ):
+        '''
+        在device上完成letterbox：通道翻转、缩放、padding和归一化都直接写入按尺寸复用的输入tensor，
+        结果与resize + to_tensor相同（缩放后不再取整为uint8）。
+        '''
+        shape, _, _ = self.letterbox_shape(imgs[0].shape, new_shape, auto)
+        key = (len(imgs), *shape)
+        inputs = self.local.__dict__.setdefault("inputs", {})
+        x = inputs.get(key, None)
+        if x is None:
+            x = inputs[key] = torch.empty(key[0], 3, *shape, device=self.device, dtype=torch.half if self.half else torch.float)
+        x.fill_(114 / 255.0)
+
+        for i, (img, t) in enumerate(zip(imgs, self.upload(imgs))):
+            _, unpad, (top, left) = self.letterbox_shape(img.shape, new_shape, auto)
+            t = t.permute(2, 0, 1).flip(0).unsqueeze(0).to(x.dtype)  # hwc(bgr) -> c(rgb)hw
+            if tuple(t.shape[2:]) != unpad:
+                t = F.interpolate(t, size=unpad, mode="bilinear", align_corners=False)
+            x[i, :, top : top + unpad[0], left : left + unpad[1]] = t[0].div_(255.0)
+        return x
+
+    def to_tensor(
+        self,
+        img
+    ):
+        if self.backend == "onnxruntime":
+            img = img.astype(np.float32) / 255.0
+            return img[None] if img.ndim == 3 else img
 
         img = torch.from_numpy(img).to(self.device)
         img = img.half() if self.half else img.float()
         img /= 255.0
 
         if img.ndimension() == 3:
-            img = img.unsqueeze(0) 
+            img = img.unsqueeze(0)
+        return img
+
+    def preprocess(
+        self,
+        img
+    ):
+        if self.device_preprocess:
+            shape = self.input_shape or self.bucket(img.shape)
+            return self.device_letterbox([img], shape or self.imgsz, auto=shape is None)
+        return self.to_tensor(self.resize(img))
+
+    def preprocess_batch(
+        self,
+        imgs,
+        shape = None
+    ):
+        # 与autoShape.forward相同：按最长边缩放后取所有图片的最大尺寸，统一letterbox后堆叠
+        shape1 = shape or self.input_shape
+        if shape1 is None:
+            shapes = [[y * self.imgsz / max(img.shape[:2]) for y in img.shape[:2]] for img in imgs]
+            shape1 = [make_divisible(x, self.stride) for x in np.stack(shapes, 0).max(0)]
+        if self.device_preprocess:
+            return self.device_letterbox(imgs, shape1, auto=False)
+        return self.to_tensor(np.stack([self.resize(img, shape1) for img in imgs], 0))
+
+    def inference(
+        self,
+        img,
+        augment = False
+    ):
+        if self.backend == "onnxruntime":
+            out = torch.from_numpy(self.session.run(None, {self.input_name: img})[0])
+            # 转换为与non_max_suppression相同的格式: [x1, y1, x2, y2, 置信度, 类别]
+            out = out[:, [1, 2, 3, 4, 6, 5, 0]]
+            return [out[out[:, 6] == i, :6] for i in range(len(img))]
 
         with torch.no_grad():
-            pred = self.model(img, augment=True)[0]
+            pred = self.model(img, augment=augment)[0]
+
+        return fast_non_max_suppression(pred, self.conf_thres, self.iou_thres, CLASSES, max_per_class=self.max_per_class)
+
+    def confident(
+        self,
+        pred
+    ):
+        # 彩票类型(0或2)、号码(1)、期号(3)都需要以足够的置信度被检出，否则认为单次推理不可靠
+        return min(self.required_conf(pred)) >= self.adaptive_conf
 
-        pred = non_max_suppression(pred, self.conf_thres, self.iou_thres)[0]
+    def required_conf(
+        self,
+        pred
+    ):
+        '''
+        返回彩票类型、号码、期号各自的最高置信度，未检出时为0。
+        '''
+        cls = pred[:, 5]
+        results = []
+        for required in REQUIRED:
+            mask = torch.isin(cls, torch.tensor(required, dtype=cls.dtype, device=cls.device))
+            results.append(pred[mask, 4].max().item() if mask.any() else 0.)
+        return results
 
+    def postprocess(
+        self,
+        pred,
+        input_shape,
+        shape
+    ):
         if not len(pred):
             return
-        
+
         # Scale boxes size back
-        pred[:, :4] = scale_coords(img.shape[2:], pred[:, :4], shape).round()
+        pred[:, :4] = scale_coords(input_shape, pred[:, :4], shape).round()
 
         pred_ = pred[:, [0, 1, 2, 3, 5]].to("cpu", int).numpy()
         cls = np.unique(pred_[:, -1], return_index=False)
@@ -67,16 +377,55 @@ class Detector:
             code = "cjdlt"
         else:
             return
-        
+
         if not 1 in cls and 3 in cls:
             return
 
         numbers = pred_[pred_[:, -1] == 1]
-        
+
         issue = pred_[pred_[:, -1] == 3]
-        
+
         return code, issue, numbers
-        
 
+    def detect(
+        self,
+        x,
+        shapes
+    ):
+        '''
+        对已经预处理好的batch做一次前向计算和一次NMS，shapes为各张原图的尺寸，返回与之顺序一致的检测结果list。
+        '''
+        preds = self.inference(x, augment=self.tta == "full-tta")
+
+        if self.tta == "adaptive":
+            retry = [i for i, pred in enumerate(preds) if not self.confident(pred)]
+            if retry:
+                for i, pred in zip(retry, self.inference(x[retry], augment=True)):
+                    preds[i] = pred
+
+        return [self.postprocess(pred, x.shape[2:], shape) for pred, shape in zip(preds, shapes)]
+
+    def __call__(
+        self,
+        img
+    ):
+        return self.detect(self.preprocess(img), [img.shape])[0]
+
+    def batch(
+        self,
+        imgs
+    ):
+        if not self.buckets:
+            return self.detect(self.preprocess_batch(imgs), [img.shape for img in imgs])
+
+        # 按尺寸分组，每组只做一次前向计算
+        groups = {}
+        for i, img in enumerate(imgs):
+            groups.setdefault(self.bucket(img.shape), []).append(i)
 
-        
\ No newline at end of file
+        results = [None] * len(imgs)
+        for shape, group in groups.items():
+            x = self.preprocess_batch([imgs[i] for i in group], shape)
+            for i, result in zip(group, self.detect(x, [imgs[i].shape for i in group])):
+                results[i] = result
+        return results
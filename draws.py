@@ -0,0 +1,165 @@
+import argparse
+import csv
+import json
+from pathlib import Path
+
+import numpy as np
+
+from utils import *
+
+
+class DrawIndex:
+    '''
+    离线开奖号码索引：期号按从小到大排列，红球、蓝球分别以bitmask保存在numpy数组中。
+    导入时对每一期只做一次winning_process，查询时只需二分查找和位运算。
+    '''
+    def __init__(
+        self,
+        code,
+        issues,
+        red,
+        blue
+    ):
+        assert code in ["ssq", "cjdlt"], f"Code {code} is illegal."
+        order = np.argsort(issues, kind="stable")
+        self.code = code
+        self.issues = np.asarray(issues, dtype=np.int64)[order]
+        self.red = np.asarray(red, dtype=np.uint64)[order]
+        self.blue = np.asarray(blue, dtype=np.uint64)[order]
+        self.decoded = {}
+
+    @classmethod
+    def from_records(
+        self,
+        code,
+        records
+    ):
+        '''
+        records为(期号, 开奖号码字符串)的可迭代对象，同一期出现多次时以最后一次为准。
+        '''
+        draws = {}
+        for issue, winning in records:
+            red, blue = winning_process(winning, code)
+            draws[int(issue)] = (to_mask(red), to_mask(blue))
+        issues = list(draws.keys())
+        red = [draws[i][0] for i in issues]
+        blue = [draws[i][1] for i in issues]
+        return DrawIndex(code, issues, red, blue)
+
+    @classmethod
+    def from_dump(
+        self,
+        code,
+        filename
+    ):
+        '''
+        从csv或json格式的历史开奖数据导入。每条记录需要有期号（expect或issue）和开奖号码，
+        开奖号码可以是与接口返回格式相同的openCode，也可以分为red、blue两项。
+        '''
+        p = Path(filename)
+        if not p.is_file():
+            raise FileNotFoundError(f"File {str(p.absolute())} not found.")
+        with open(p, "r", encoding="utf-8") as f:
+            if p.suffix.lower() == ".json":
+                rows = json.load(f)
+                if isinstance(rows, dict):
+                    rows = rows["data"]
+            else:
+                rows = list(csv.DictReader(f))
+
+        def parse(row):
+            issue = row.get("expect", row.get("issue"))
+            if "openCode" in row:
+                return issue, row["openCode"]
+            red, blue = row["red"], row["blue"]
+            if isinstance(red, list):
+                red, blue = " ".join(map(str, red)), " ".join(map(str, blue))
+            return issue, f"{red} + {blue}"
+
+        return DrawIndex.from_records(code, map(parse, rows))
+
+    @classmethod
+    def load(
+        self,
+        filename
+    ):
+        data = np.load(filename)
+        return DrawIndex(str(data["code"]), data["issues"], data["red"], data["blue"])
+
+    def save(
+        self,
+        filename
+    ):
+        Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        np.savez(filename, code=self.code, issues=self.issues, red=self.red, blue=self.blue)
+
+    def merge(
+        self,
+        other
+    ):
+        '''
+        合并两个索引，期号重复时以other为准。
+        '''
+        assert self.code == other.code, "Cannot merge indexes of different lotteries."
+        keep = ~np.isin(self.issues, other.issues)
+        return DrawIndex(
+            self.code,
+            np.concatenate([self.issues[keep], other.issues]),
+            np.concatenate([self.red[keep], other.red]),
+            np.concatenate([self.blue[keep], other.blue])
+        )
+
+    @property
+    def latest(self):
+        return int(self.issues[-1]) if len(self.issues) else -1
+
+    def find(
+        self,
+        issue
+    ):
+        '''
+        返回期号在数组中的位置，不存在时返回None。
+        '''
+        issue = int(issue)
+        i = int(np.searchsorted(self.issues, issue))
+        if i < len(self.issues) and self.issues[i] == issue:
+            return i
+
+    def get(
+        self,
+        issue
+    ):
+        '''
+        返回与winning_process格式相同的开奖号码，不在索引中时返回None。
+        '''
+        i = self.find(issue)
+        if i is None:
+            return
+        winning = self.decoded.get(i, None)
+        if winning is None:
+            winning = self.decoded[i] = (from_mask(self.red[i]), from_mask(self.blue[i]))
+        return winning
+
+    def __len__(self):
+        return len(self.issues)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--code", type=str, required=True, choices=["ssq", "cjdlt"], help="lottery code")
+    parser.add_argument("--index_dir", type=str, default="./checkouts/draws", help="directory of draw indexes")
+    parser.add_argument("--replace", action="store_true", help="replace the existing index instead of merging into it")
+    parser.add_argument("dump", type=str, nargs="+", help="csv or json files of draw history")
+
+    opt = parser.parse_args()
+
+    index = None
+    target = Path(opt.index_dir) / f"{opt.code}.npz"
+    if target.is_file() and not opt.replace:
+        index = DrawIndex.load(target)
+    for dump in opt.dump:
+        imported = DrawIndex.from_dump(opt.code, dump)
+        index = imported if index is None else index.merge(imported)
+    index.save(target)
+
+    print(f"{len(index)} draws of {opt.code} saved to {target}, latest issue: {index.latest}")
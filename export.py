@@ -0,0 +1,398 @@
+import argparse
+import io
+import json
+import time
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+
+from detector import Detector, load_fused
+from models.yolo.utils.datasets import letterbox
+from models.yolo.utils.general import box_iou
+from models.yolo.utils.metrics import ap_per_class
+from pipeline import list_images
+from recognizer import Recognizer, quantize_dynamic
+from utils import *
+from models.yolo.experimental import End2End
+
+
+def add_metadata(
+    model_file,
+    meta
+):
+    '''
+    把meta中的值以json字符串写入onnx模型的metadata。
+    '''
+    import onnx
+
+    model = onnx.load(model_file)
+    props = {p.key: p for p in model.metadata_props}
+    for key, value in meta.items():
+        value = value if isinstance(value, str) else json.dumps(value)
+        if key in props:
+            props[key].value = value
+        else:
+            model.metadata_props.add(key=key, value=value)
+    onnx.save(model, model_file)
+
+
+def export_detector(
+    weights,
+    output = None,
+    imgsz = (640, 640),
+    conf_thres = 0.25,
+    iou_thres = 0.45,
+    max_obj = 100,
+    opset = 12
+):
+    '''
+    把检测模型导出为包含NMS的onnx模型，供Detector(backend="onnxruntime")使用。
+    输入尺寸固定为imgsz，batch维度可变。
+    '''
+    output = output or str(Path(weights).with_suffix(".onnx"))
+    model = load_fused(weights, "cpu")
+    detect = model.model[-1]
+    detect.export = False
+    n_classes = detect.nc
+
+    model = End2End(model, max_obj, iou_thres, conf_thres, max(imgsz), torch.device("cpu"), n_classes)
+    model.eval()
+
+    img = torch.zeros(1, 3, *imgsz)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            img,
+            output,
+            opset_version=opset,
+            input_names=["images"],
+            output_names=["output"],
+            dynamic_axes={"images": {0: "batch"}, "output": {0: "detections"}}
+        )
+    # NMS的阈值在导出时固定，保存在metadata中，Detector加载时据此检查运行时传入的阈值
+    add_metadata(output, {"conf_thres": conf_thres, "iou_thres": iou_thres, "max_obj": max_obj})
+    print(f"Detector exported to {output}")
+    return output
+
+
+class CTCRecognizer(nn.Module):
+    '''
+    只接收图片输入的CTC识别模型，输出各时间步未经softmax的logits。
+    宽度可变时AdaptiveAvgPool2d((None, 1))无法导出，改为等价的mean。
+    '''
+    def __init__(self, model):
+        super(CTCRecognizer, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        model = self.model
+        if not model.stages["Trans"] == "None":
+            x = model.Transformation(x)
+        feature = model.FeatureExtraction(x).permute(0, 3, 1, 2).mean(3)  # [b, c, h, w] -> [b, w, c]
+        if model.stages["Seq"] == "BiLSTM":
+            feature = model.SequenceModeling(feature)
+        return model.Prediction(feature.contiguous())
+
+
+def export_recognizer(
+    weights,
+    output = None,
+    opset = 12
+):
+    '''
+    把识别模型导出为batch和宽度维度可变的onnx模型，供Recognizer(backend="onnxruntime")使用。
+    字符集、ignore_idx和模型参数保存在onnx的metadata中。
+    '''
+    import onnx
+
+    output = output or str(Path(weights).with_suffix(".onnx"))
+    ckpt = torch.load(weights, "cpu")
+    model, converter = ckpt["model"].float().eval(), ckpt["converter"]
+    opt = model.opt
+    assert opt.Prediction == "CTC", "Only CTC recognizer can be exported."
+
+    img = torch.zeros(1, opt.input_channel, opt.imgH, opt.imgW)
+    with torch.no_grad():
+        torch.onnx.export(
+            CTCRecognizer(model),
+            img,
+            output,
+            opset_version=opset,
+            input_names=["images"],
+            output_names=["logits"],
+            dynamic_axes={"images": {0: "batch", 3: "width"}, "logits": {0: "batch", 1: "steps"}}
+        )
+
+    onnx_model = onnx.load(output)
+    meta = {
+        "opt": json.dumps(dict(opt), ensure_ascii=False),
+        "character": json.dumps(converter.character[1:], ensure_ascii=False),
+        "ignore_idx": json.dumps(converter.ignore_idx)
+    }
+    for key, value in meta.items():
+        onnx_model.metadata_props.add(key=key, value=value)
+    onnx.save(onnx_model, output)
+    print(f"Recognizer exported to {output}")
+    return output
+
+
+def quantize_recognizer(
+    weights,
+    output = None
+):
+    '''
+    对识别模型做一次动态int8量化并保存，之后可以像普通模型一样由Recognizer加载。
+    '''
+    output = output or str(Path(weights).with_suffix(".int8.pt"))
+    ckpt = torch.load(weights, "cpu")
+    ckpt["model"] = quantize_dynamic(ckpt["model"].float())
+    torch.save(ckpt, output)
+    print(f"Quantized recognizer saved to {output}")
+    return output
+
+
+def model_size(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def edit_distance(a, b):
+    row = list(range(len(b) + 1))
+    for i, x in enumerate(a, 1):
+        prev, row[0] = row[0], i
+        for j, y in enumerate(b, 1):
+            prev, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, prev + (x != y))
+    return row[-1]
+
+
+def compare_recognizers(
+    reference,
+    candidate,
+    detector,
+    images,
+    repeat = 3
+):
+    '''
+    在images上对比两个识别模型：用fp32检测模型裁切出号码和期号，
+    以reference的识别结果为准，统计candidate的整行一致率、字符一致率和耗时。
+    测试图片没有标注，这里的"准确率"是相对于reference的一致程度。
+    '''
+    det = Detector(detector, tta="none")
+    crops = []
+    for f in list_images(images):
+        img = imread(f)
+        detection = det(img)
+        if detection:
+            _, issue, numbers = detection
+            crops.extend(crop(img, sort_box(numbers)) + crop(img, issue))
+    assert crops, f"Nothing detected in {images}."
+
+    report = {"crops": len(crops)}
+    outputs = {}
+    for name, recognizer in (("reference", reference), ("candidate", candidate)):
+        recognizer(crops[:1])     # warmup
+        start = time.perf_counter()
+        for _ in range(repeat):
+            outputs[name] = recognizer(crops)
+        report[f"{name}_ms_per_crop"] = (time.perf_counter() - start) * 1000 / repeat / len(crops)
+        report[f"{name}_bytes"] = model_size(recognizer.model)
+
+    texts = [(ref[0], cand[0]) for ref, cand in zip(outputs["reference"], outputs["candidate"])]
+    chars = sum(max(len(ref), 1) for ref, _ in texts)
+    report["line_agreement"] = sum(ref == cand for ref, cand in texts) / len(texts)
+    report["char_agreement"] = 1 - sum(edit_distance(ref, cand) for ref, cand in texts) / chars
+    report["confidence_delta"] = float(np.mean([
+        cand[1] - ref[1] for ref, cand in zip(outputs["reference"], outputs["candidate"])
+    ]))
+    report["speedup"] = report["reference_ms_per_crop"] / report["candidate_ms_per_crop"]
+    return report
+
+
+class CalibrationReader:
+    '''
+    为onnxruntime静态量化逐张提供校准图片，预处理与Detector(backend="onnxruntime")相同。
+    '''
+    def __init__(
+        self,
+        images,
+        input_name,
+        imgsz,
+        limit = None
+    ):
+        self.files = list_images(images)[:limit]
+        assert self.files, f"No calibration image found in {images}."
+        self.input_name = input_name
+        self.imgsz = imgsz
+        self.rewind()
+
+    def rewind(self):
+        self.iterator = iter(self.files)
+
+    def get_next(self):
+        f = next(self.iterator, None)
+        if f is None:
+            return
+        img = letterbox(imread(f), new_shape=self.imgsz, auto=False)[0]
+        img = np.ascontiguousarray(img[:, :, ::-1].transpose(2, 0, 1))
+        return {self.input_name: img[None].astype(np.float32) / 255.0}
+
+
+def quantize_detector(
+    weights,
+    images,
+    output = None,
+    op_types = ("Conv",),
+    per_channel = True,
+    limit = None
+):
+    '''
+    对export_detector导出的onnx检测模型做静态int8量化(QDQ格式)，用images中的真实彩票照片校准。
+    weights为.pt文件时先导出fp32的onnx模型。按通道量化需要opset 13以上。
+    '''
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+    import onnx
+
+    if Path(weights).suffix != ".onnx":
+        weights = export_detector(weights, opset=13)
+    output = output or str(Path(weights).with_suffix(".int8.onnx"))
+
+    model = onnx.load(weights)
+    opset = max(o.version for o in model.opset_import if o.domain in ("", "ai.onnx"))
+    assert opset >= 13 or not per_channel, f"Per channel quantization needs opset 13 or later, got {opset}."
+    graph = model.graph
+    input_name = graph.input[0].name
+    imgsz = [d.dim_value for d in graph.input[0].type.tensor_type.shape.dim[2:]]
+
+    quantize_static(
+        weights,
+        output,
+        CalibrationReader(images, input_name, imgsz, limit),
+        quant_format=QuantFormat.QDQ,
+        op_types_to_quantize=list(op_types),
+        per_channel=per_channel,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8
+    )
+    add_metadata(output, {p.key: p.value for p in model.metadata_props})
+    print(f"Quantized detector saved to {output}")
+    return weights, output
+
+
+def match_detections(
+    pred,
+    labels,
+    iouv
+):
+    '''
+    与yolov7 test.py相同的匹配方式，返回pred中每个框在各iou阈值下是否为正确检测。
+    pred、labels均为[x1, y1, x2, y2, 置信度, 类别]。
+    '''
+    correct = torch.zeros(len(pred), len(iouv), dtype=torch.bool)
+    if not len(pred) or not len(labels):
+        return correct
+    detected = set()
+    for cls in torch.unique(labels[:, 5]):
+        ti = (labels[:, 5] == cls).nonzero().view(-1)
+        pi = (pred[:, 5] == cls).nonzero().view(-1)
+        if not len(pi):
+            continue
+        ious, i = box_iou(pred[pi, :4], labels[ti, :4]).max(1)
+        for j in (ious > iouv[0]).nonzero().view(-1):
+            d = ti[i[j]].item()
+            if d not in detected:
+                detected.add(d)
+                correct[pi[j]] = ious[j] > iouv
+    return correct
+
+
+def compare_detectors(
+    reference,
+    candidate,
+    images,
+    repeat = 3
+):
+    '''
+    在images上对比两个onnxruntime检测模型。测试图片没有标注，以reference的检测结果作为标签，
+    用ap_per_class计算candidate的mAP@0.5和mAP@0.5:0.95（reference自身为1），同时统计单张推理耗时。
+    '''
+    iouv = torch.linspace(0.5, 0.95, 10)
+    xs = [reference.preprocess(imread(f)) for f in list_images(images)]
+    assert xs, f"No image found in {images}."
+
+    report = {"images": len(xs)}
+    outputs = {}
+    for name, detector in (("reference", reference), ("candidate", candidate)):
+        detector.inference(xs[0])     # warmup
+        start = time.perf_counter()
+        for _ in range(repeat):
+            outputs[name] = [detector.inference(x)[0] for x in xs]
+        report[f"{name}_ms_per_image"] = (time.perf_counter() - start) * 1000 / repeat / len(xs)
+
+    stats = []
+    for pred, labels in zip(outputs["candidate"], outputs["reference"]):
+        stats.append((match_detections(pred, labels, iouv), pred[:, 4], pred[:, 5], labels[:, 5]))
+    tp, conf, pred_cls, target_cls = [torch.cat(x, 0).numpy() for x in zip(*stats)]
+
+    report["labels"] = len(target_cls)
+    if len(target_cls) and len(conf):
+        ap = ap_per_class(tp, conf, pred_cls, target_cls)[2]
+        report["map50"], report["map"] = float(ap[:, 0].mean()), float(ap.mean())
+    else:
+        report["map50"] = report["map"] = float(len(target_cls) == len(conf))
+    report["map_delta"] = report["map"] - 1
+    report["speedup"] = report["reference_ms_per_image"] / report["candidate_ms_per_image"]
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("detector", help="export detector to onnx with NMS included")
+    p.add_argument("--weights", type=str, default="./checkouts/detection.pt", help="detector model file")
+    p.add_argument("--output", type=str, default=None, help="onnx file, next to weights by default")
+    p.add_argument("--imgsz", type=int, nargs=2, default=[640, 640], help="input height and width")
+    p.add_argument("--conf_thres", type=float, default=0.25, help="detection confidence threshold")
+    p.add_argument("--iou_thres", type=float, default=0.45, help="detection iou threshold")
+    p.add_argument("--max_obj", type=int, default=100, help="max number of detections per image")
+    p.add_argument("--opset", type=int, default=12, help="onnx opset version")
+
+    p = subparsers.add_parser("recognizer", help="export CTC recognizer to onnx with dynamic batch and width")
+    p.add_argument("--weights", type=str, default="./checkouts/recognition.pt", help="recognizer model file")
+    p.add_argument("--output", type=str, default=None, help="onnx file, next to weights by default")
+    p.add_argument("--opset", type=int, default=12, help="onnx opset version")
+
+    p = subparsers.add_parser("quantize-recognizer", help="save a dynamic int8 recognizer and compare it with fp32")
+    p.add_argument("--weights", type=str, default="./checkouts/recognition.pt", help="fp32 recognizer model file")
+    p.add_argument("--output", type=str, default=None, help="quantized model file, next to weights by default")
+    p.add_argument("--detector", type=str, default="./checkouts/detection.pt", help="detector used to crop report images")
+    p.add_argument("--images", type=str, default="./test_images", help="directory or glob of report images, empty to skip report")
+
+    p = subparsers.add_parser("quantize-detector", help="statically quantize the onnx detector and compare it with fp32")
+    p.add_argument("--weights", type=str, default="./checkouts/detection.pt", help="fp32 onnx detector, exported first if a .pt file is given")
+    p.add_argument("--output", type=str, default=None, help="quantized onnx file, next to weights by default")
+    p.add_argument("--images", type=str, default="./test_images", help="directory or glob of calibration and report images")
+    p.add_argument("--limit", type=int, default=None, help="max number of calibration images")
+    p.add_argument("--op_types", type=str, nargs="+", default=["Conv"], help="onnx operator types to quantize")
+    p.add_argument("--per_tensor", action="store_true", help="quantize weights per tensor rather than per channel")
+    p.add_argument("--no_report", action="store_true", help="skip comparing with the fp32 detector")
+
+    opt = parser.parse_args()
+
+    if opt.command == "detector":
+        export_detector(opt.weights, opt.output, tuple(opt.imgsz), opt.conf_thres, opt.iou_thres, opt.max_obj, opt.opset)
+    elif opt.command == "recognizer":
+        export_recognizer(opt.weights, opt.output, opt.opset)
+    elif opt.command == "quantize-recognizer":
+        output = quantize_recognizer(opt.weights, opt.output)
+        if opt.images:
+            report = compare_recognizers(Recognizer(opt.weights), Recognizer(output), opt.detector, opt.images)
+            print(json.dumps(report, indent=2))
+    elif opt.command == "quantize-detector":
+        fp32, int8 = quantize_detector(opt.weights, opt.images, opt.output, opt.op_types, not opt.per_tensor, opt.limit)
+        if not opt.no_report:
+            reference = Detector(fp32, tta="none", backend="onnxruntime")
+            candidate = Detector(int8, tta="none", backend="onnxruntime")
+            print(json.dumps(compare_detectors(reference, candidate, opt.images), indent=2))
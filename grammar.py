@@ -0,0 +1,75 @@
+import numpy as np
+
+
+# beam search只在彩票用到的字符里搜索：数字、分隔符、注号和号码区的标题字
+CLASSES = {
+    "digit": "0123456789",
+    "sep": "+-* ",
+    "open": "(",
+    "close": ")",
+    "label": "ABCDE",
+    "head": "红蓝前后区胆拖单复倍数",
+    "issue": "第期"
+}
+ALPHABET = "".join(CLASSES.values())
+
+
+class LineGrammar:
+    '''
+    按字符类别定义的确定有限自动机，状态0为初始状态，描述一种彩票文字行的合法格式。
+    compile把它展开为识别模型字符集上的状态转移表，不在任何类别中的字符（包括blank）转移到-1，即禁止输出。
+    '''
+    def __init__(
+        self,
+        transitions,
+        accept
+    ):
+        self.transitions = transitions    # {状态: {类别: 下一状态}}
+        self.accept = accept
+        self.compiled = {}
+
+    def compile(self, character):
+        key = tuple(character)
+        if key not in self.compiled:
+            table = np.full((len(self.transitions), len(character)), -1, dtype=np.int64)
+            for c, char in enumerate(character):
+                for cls, chars in CLASSES.items():
+                    if char not in chars:
+                        continue
+                    for state, edges in self.transitions.items():
+                        if cls in edges:
+                            table[state, c] = edges[cls]
+
+            accept = np.zeros(len(self.transitions), dtype=bool)
+            accept[list(self.accept)] = True
+            self.compiled[key] = table, accept
+        return self.compiled[key]
+
+
+# 号码行："A"或"1)"开头的单式、"红胆"等标题开头的复式和胆拖，以及没有标题的续行
+# 号码最多两位，倍数可以写成"*2"或"(2倍)"
+NUMBERS = LineGrammar(
+    {
+        0: {"head": 1, "label": 2, "digit": 3, "open": 6},    # 行首
+        1: {"head": 1, "digit": 3, "sep": 5, "open": 6},    # 标题
+        2: {"digit": 3, "sep": 5, "close": 5},    # 注号
+        3: {"digit": 4, "sep": 5, "close": 5, "head": 1, "open": 6},    # 一位数字
+        4: {"sep": 5, "head": 1, "open": 6},    # 两位数字
+        5: {"digit": 3, "sep": 5, "head": 1, "open": 6},    # 分隔符
+        6: {"digit": 6, "head": 6, "sep": 6, "close": 5}    # 括号内
+    },
+    accept=(1, 3, 4, 5)
+)
+
+# 期号行：只有一段数字，例如"第2023001期"
+ISSUE = LineGrammar(
+    {
+        0: {"issue": 0, "head": 0, "sep": 0, "digit": 1},
+        1: {"digit": 1, "issue": 2, "sep": 2},
+        2: {"issue": 2, "sep": 2}
+    },
+    accept=(1, 2)
+)
+
+# 不限定格式，只限定字符集
+ANY = LineGrammar({0: {cls: 0 for cls in CLASSES}}, accept=(0,))
@@ -1,16 +1,25 @@
 import argparse
 import sys
+from itertools import islice
 from pathlib import Path
 
 import cv2
 import numpy as np
 import torch
 
-from detector import Detector
-from recognizer import Recognizer
+from detector import Detector, TTA_MODES, BACKENDS
+from recognizer import Recognizer, QUANTIZE_MODES
 from checker import Checker
+from pipeline import Pipeline, list_images
+from quality import QualityGate, QUALITY_MODES
+from grammar import NUMBERS, ISSUE
+from models.yolo.utils.datasets import img_formats
 from utils import *
 
+
+ROTATIONS = (0, 3, 2, 1)    # np.rot90的k，依次为原图、顺时针旋转90度、180度、270度
+
+
 class Lottery:
 
     def __init__(
@@ -20,37 +29,80 @@ class Lottery:
         detect_conf_thres = 0.25, 
         detect_iou_thres = 0.45, 
         cert_ = "cert_.txt",
+        cache_ = "./checkouts/draws.db",
+        index_dir = "./checkouts/draws",
         timeout = 5,
-        cuda = True
+        cuda = True,
+        tta = "full-tta",
+        detector_backend = "torch",
+        recognizer_backend = "torch",
+        recognizer_quantize = "none",
+        buckets = None,
+        device_preprocess = False,
+        reduced_decode = False,
+        orientation = False,
+        quality = "off",
+        width_buckets = None,
+        beam_threshold = None
     ):
         self.detector_ = detector
         self.detect_conf_thres = detect_conf_thres
         self.detect_iou_thres = detect_iou_thres
         self.recognizer_ = recognizer
         self.cert_ = cert_
+        self.cache_ = cache_
+        self.index_dir = index_dir
         self.timeout = timeout
+        self.tta = tta
+        self.detector_backend = detector_backend
+        self.recognizer_backend = recognizer_backend
+        self.recognizer_quantize = recognizer_quantize
+        self.buckets = buckets
+        self.device_preprocess = device_preprocess
+        self.reduced_decode = reduced_decode
+        self.orientation = orientation
+        self.width_buckets = width_buckets
+        self.beam_threshold = beam_threshold
         self.device = "cuda" if torch.cuda.is_available() and cuda else "cpu"
 
+        self.quality = QualityGate(quality) if isinstance(quality, str) else quality
+
         self.init_detector()
         self.init_recognizer()
         self.init_checker()
 
     def init_detector(self):
-        self.detector = Detector(self.detector_, self.detect_conf_thres, self.detect_iou_thres, self.device)
+        self.detector = Detector(
+            self.detector_, 
+            self.detect_conf_thres, 
+            self.detect_iou_thres, 
+            self.device, 
+            self.tta, 
+            backend=self.detector_backend,
+            buckets=self.buckets,
+            device_preprocess=self.device_preprocess
+        )
 
     def init_recognizer(self):
-        self.recognizer = Recognizer(self.recognizer_, self.device)
+        self.recognizer = Recognizer(
+            self.recognizer_, 
+            self.device, 
+            backend=self.recognizer_backend, 
+            quantize=self.recognizer_quantize,
+            width_buckets=self.width_buckets,
+            beam_threshold=self.beam_threshold
+        )
 
     def init_checker(self):
-        self.checker = Checker.from_file(self.cert_, timeout=self.timeout)
+        self.checker = Checker.from_file(self.cert_, timeout=self.timeout, cache=self.cache_, index_dir=self.index_dir)
 
-    def imread(self, img):
+    def imread(self, img, flag=cv2.IMREAD_COLOR):
         if isinstance(img, str):
             p = Path(img)
             if not p.is_file():
                 raise FileNotFoundError()
             p = str(p.absolute())
-            img = imread(p)  # BGR
+            img = imread(p, flag)  # BGR
             assert img is not None, 'Cannot read image ' + str(p)
             return img
         elif isinstance(img, np.ndarray):
@@ -58,6 +110,35 @@ class Lottery:
         else:
             raise TypeError("Please input an image file.")
 
+    def load(self, img):
+        '''
+        读取用于检测的图片，返回(图片, 文件名)。reduced_decode时对图片文件做缩小解码，
+        需要裁切时再由restore完整解码；没有缩小（图片本身不大）或其他情况下文件名为None。
+        '''
+        if self.reduced_decode and isinstance(img, str):
+            flag, factor = reduced_flag(str(Path(img).absolute()), self.detector.imgsz)
+            small = self.imread(img, flag)
+            self.quality(small, scale=factor)
+            return small, (img if factor > 1 else None)
+        img = self.imread(img)
+        self.quality(img)
+        return img, None
+
+    def restore(self, img, source, detection, rotation=0):
+        '''
+        检测成功后才完整解码原图，并把检测框映射回原图尺寸，返回(原图, 检测结果)。
+        rotation为检测时对图片做的np.rot90次数。
+        '''
+        if source is None or not detection:
+            return img, detection
+        full = np.ascontiguousarray(np.rot90(self.imread(source), rotation))
+        if full.shape == img.shape:
+            return img, detection
+        if (full.shape[0] > full.shape[1]) != (img.shape[0] > img.shape[1]):
+            return full, self.detect(full)  # 两种解码对exif方向的处理不一致时在原图上重新检测
+        code, issue, numbers = detection
+        return full, (code, scale_boxes(issue, img.shape, full.shape), scale_boxes(numbers, img.shape, full.shape))
+
     def detect(self, img):
         detection = self.detector(img)
         if not detection:
@@ -65,17 +146,58 @@ class Lottery:
         code, issue, numbers = detection
         return code, issue, numbers
 
-    def recognize(self, img, code, issue, numbers, result_process=True):
-        issue = crop(img, issue)[0]
-        numbers = sort_box(numbers)
-        numbers = crop(img, numbers)
-
-        numbers.append(issue)
+    def orient(self, img, ks=ROTATIONS):
+        '''
+        把ks中各个方向的图片letterbox到同一正方形尺寸后合并为一个batch，只做一次检测，
+        选出彩票类型、号码、期号置信度之和最高的方向，返回(旋转后的图片, 检测结果, np.rot90的k)。
+        '''
+        detector = self.detector
+        rotations = [np.ascontiguousarray(np.rot90(img, k)) for k in ks]
+        x = detector.preprocess_batch(rotations, detector.input_shape or (detector.imgsz, detector.imgsz))
+        preds = detector.inference(x, augment=detector.tta == "full-tta")
+
+        best = max(range(len(preds)), key=lambda i: sum(detector.required_conf(preds[i])))
+        pred = preds[best]
+        if detector.tta == "adaptive" and not detector.confident(pred):
+            pred = detector.inference(x[best : best + 1], augment=True)[0]
+
+        img = rotations[best]
+        return img, detector.postprocess(pred, x.shape[2:], img.shape), ks[best]
+
+    def reorient(self, img, detection):
+        '''
+        原图检测失败且开启orientation时，再把其余三个方向合并为一个batch检测，返回(图片, 检测结果, np.rot90的k)。
+        方向正确的图片只需要一次检测。
+        '''
+        if detection or not self.orientation:
+            return img, detection, 0
+        return self.orient(img, ROTATIONS[1:])
+
+    def crop(self, img, code, issue, numbers):
+        '''
+        裁切号码和期号，丢弃面积为0的检测框；没有号码或期号时抛出MissingInfoException。
+        '''
+        issue = [c for c in crop(img, issue) if c.size] if len(issue) else []
+        numbers = [c for c in crop(img, sort_box(numbers)) if c.size] if len(numbers) else []
+        if not issue or not numbers:
+            raise MissingInfoException("没有检测到号码或期号，请调整图片后重试。")
+
+        numbers.append(issue[0])
+        return numbers
+
+    def grammars(self, crops):
+        # crop的结果最后一张是期号，其余是号码行
+        return [NUMBERS] * (len(crops) - 1) + [ISSUE]
 
-        recognition = self.recognizer(numbers)
+    def recognize(self, img, code, issue, numbers, result_process=True):
+        crops = self.crop(img, code, issue, numbers)
+        recognition = self.recognizer(crops, self.grammars(crops))
         if not recognition:
             return
 
+        return self.parse(code, recognition, result_process)
+
+    def parse(self, code, recognition, result_process=True):
         issue, _ = recognition.pop()
         numbers = recognition
 
@@ -95,8 +217,12 @@ class Lottery:
         return code, issue, winning, numbers, hits
 
     def __call__(self, img, recognition_only=False):
-        img = self.imread(img)
-        detection = self.detect(img)
+        img, source = self.load(img)
+        img, detection, rotation = self.reorient(img, self.detect(img))
+        if not detection:
+            return
+
+        img, detection = self.restore(img, source, detection, rotation)
         if not detection:
             return
 
@@ -109,6 +235,104 @@ class Lottery:
 
         return self.check(*recognition)
 
+    def batch(self, imgs, recognition_only=False, batch_size=8):
+        '''
+        批量识别，每batch_size张图片只做一次检测和一次ocr前向计算，同一期的开奖号码只查询一次。
+        结果按输入顺序逐张yield：未检测到彩票信息时为None，处理出错时为对应的异常，不影响其他图片。
+        '''
+        imgs = iter(imgs)
+        while True:
+            chunk = list(islice(imgs, batch_size))
+            if not chunk:
+                return
+            yield from self.process_batch(chunk, recognition_only)
+
+    def process_batch(self, chunk, recognition_only=False):
+        results = [None] * len(chunk)
+
+        loaded = []
+        for i, img in enumerate(chunk):
+            try:
+                loaded.append((i, *self.load(img)))
+            except Exception as e:
+                results[i] = e
+
+        if not loaded:
+            return results
+
+        try:
+            detections = self.detector.batch([img for _, img, _ in loaded])
+        except Exception as e:
+            for i, _, _ in loaded:
+                results[i] = e
+            return results
+
+        indices, imgs, restored = [], [], []
+        for (i, img, source), detection in zip(loaded, detections):
+            try:
+                img, detection, rotation = self.reorient(img, detection)
+                img, detection = self.restore(img, source, detection, rotation)
+            except Exception as e:
+                results[i] = e
+                continue
+            indices.append(i)
+            imgs.append(img)
+            restored.append(detection)
+
+        for i, result in zip(indices, self.finish(imgs, restored, recognition_only)):
+            results[i] = result
+        return results
+
+    def finish(self, imgs, detections, recognition_only=False):
+        '''
+        对一批图片的检测结果统一做ocr和开奖查询，返回与imgs顺序一致的结果list。
+        单张图片裁切或解析出错时只把该图片的结果记为对应的异常。
+        '''
+        results = [None] * len(imgs)
+
+        crops, grammars, owners = [], [], []
+        for i, (img, detection) in enumerate(zip(imgs, detections)):
+            if not detection:
+                continue
+            try:
+                cropped = self.crop(img, *detection)
+            except Exception as e:
+                results[i] = e
+                continue
+            owners.append((i, detection[0], len(crops), len(crops) + len(cropped)))
+            crops.extend(cropped)
+            grammars.extend(self.grammars(cropped))
+
+        try:
+            recognition = self.recognizer(crops, grammars) if crops else []
+        except Exception as e:
+            for i, *_ in owners:
+                results[i] = e
+            owners = []
+
+        for i, code, start, end in owners:
+            try:
+                results[i] = self.parse(code, recognition[start : end])
+            except Exception as e:
+                results[i] = e
+
+        if recognition_only:
+            return results
+
+        winnings = self.checker.query_many(result[:2] for result in results if isinstance(result, tuple))
+
+        for i, result in enumerate(results):
+            if not isinstance(result, tuple):
+                continue
+            code, issue, numbers = result
+            winning = winnings[(code, issue)]
+            if isinstance(winning, Exception):
+                results[i] = winning
+            else:
+                results[i] = code, issue, winning, numbers, hit_check(numbers, winning)
+
+        return results
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -117,10 +341,29 @@ if __name__ == "__main__":
     parser.add_argument("--detect_conf_thres", type=float, default=0.25, help="detection confidence threshold")
     parser.add_argument("--detect_iou_thres", type=float, default=0.45, help="detection iou threshold")
     parser.add_argument("--cert_", type=str, default="./cert_.txt", help="API infomation")
+    parser.add_argument("--cache_", type=str, default="./checkouts/draws.db", help="sqlite file caching winning numbers")
+    parser.add_argument("--index_dir", type=str, default="./checkouts/draws", help="directory of offline draw indexes")
     parser.add_argument("--timeout", type=int, default=5, help="timeout for waiting response")
     parser.add_argument("--cuda", action="store_true", help="use cuda or cpu")
+    parser.add_argument("--tta", type=str, default="full-tta", choices=TTA_MODES, help="test-time augmentation mode of detector")
+    parser.add_argument("--detector_backend", type=str, default="torch", choices=BACKENDS, help="run detector with pytorch or onnxruntime")
+    parser.add_argument("--buckets", type=str, nargs="+", default=None, help="fixed detector input shapes like 640x480, images go to the closest one")
+    parser.add_argument("--device_preprocess", action="store_true", help="letterbox images on the detector device rather than with cv2")
+    parser.add_argument("--reduced_decode", action="store_true", help="detect on a reduced decode of large photos, fully decode only for cropping")
+    parser.add_argument("--orientation", action="store_true", help="if the upright image fails, detect the other three rotations in one batch and recognize the best one")
+    parser.add_argument("--quality", type=str, default="off", choices=QUALITY_MODES, help="check resolution, sharpness and exposure before running models")
+    parser.add_argument("--recognizer_backend", type=str, default="torch", choices=BACKENDS, help="run recognizer with pytorch or onnxruntime")
+    parser.add_argument("--recognizer_quantize", type=str, default="none", choices=QUANTIZE_MODES, help="quantize recognizer on loading, dynamic runs on cpu only")
+    parser.add_argument("--width_buckets", type=float, nargs="+", default=None, help="ocr crops are padded to the closest of these fractions of imgW, e.g. 0.25 0.5 0.75 1")
+    parser.add_argument("--beam_threshold", type=float, default=None, help="re-decode lines whose greedy confidence is below this with grammar-constrained beam search")
     parser.add_argument("--recognition_only", action="store_true", help="return recognition results rather than checked results")
-    parser.add_argument("image", type=str, help="image with lottery in it")
+    parser.add_argument("--batch", type=str, default=None, help="directory of images to be processed in batch")
+    parser.add_argument("--batch_size", type=int, default=8, help="number of images per detector forward in batch mode")
+    parser.add_argument("--input_dir", type=str, default=None, help="directory or glob of images to be streamed as jsonl")
+    parser.add_argument("--workers", type=int, default=4, help="number of decoding threads in streaming mode")
+    parser.add_argument("--prefetch", type=int, default=16, help="max number of decoded images waiting for inference")
+    parser.add_argument("--output", type=str, default=None, help="jsonl file for streaming results, stdout by default")
+    parser.add_argument("image", type=str, nargs="?", help="image with lottery in it")
 
     opt = parser.parse_args()
 
@@ -130,10 +373,54 @@ if __name__ == "__main__":
         detect_conf_thres=opt.detect_conf_thres,
         detect_iou_thres=opt.detect_iou_thres,
         cert_=opt.cert_,
+        cache_=opt.cache_,
+        index_dir=opt.index_dir,
         timeout=opt.timeout,
-        cuda=opt.cuda
+        cuda=opt.cuda,
+        tta=opt.tta,
+        detector_backend=opt.detector_backend,
+        recognizer_backend=opt.recognizer_backend,
+        recognizer_quantize=opt.recognizer_quantize,
+        buckets=[tuple(map(int, b.split("x"))) for b in opt.buckets] if opt.buckets else None,
+        device_preprocess=opt.device_preprocess,
+        reduced_decode=opt.reduced_decode,
+        orientation=opt.orientation,
+        quality=opt.quality,
+        width_buckets=opt.width_buckets,
+        beam_threshold=opt.beam_threshold
     )
 
+    if opt.input_dir:
+        pipeline = Pipeline(l, opt.workers, opt.prefetch, opt.batch_size)
+        files = list_images(opt.input_dir)
+        if opt.output:
+            with open(opt.output, "w", encoding="utf-8") as f:
+                pipeline.dump(files, f, opt.recognition_only)
+        else:
+            pipeline.dump(files, sys.stdout, opt.recognition_only)
+        if opt.quality != "off":
+            print(l.quality.stats(), file=sys.stderr)
+        if opt.width_buckets or opt.beam_threshold is not None:
+            print(l.recognizer.stats(), file=sys.stderr)
+        sys.exit()
+
+    if opt.batch:
+        files = sorted(str(p) for p in Path(opt.batch).iterdir() if p.suffix[1:].lower() in img_formats)
+        for f, result in zip(files, l.batch(files, opt.recognition_only, opt.batch_size)):
+            print(f)
+            if isinstance(result, Exception):
+                print(result)
+            elif not result:
+                print("Sorry, something is wrong. You may try again.")
+            else:
+                print(Result.fromTuple(result))
+            print()
+        if opt.quality != "off":
+            print(l.quality.stats())
+        if opt.width_buckets or opt.beam_threshold is not None:
+            print(l.recognizer.stats())
+        sys.exit()
+
     assert opt.image, "Please specify an image containing lottery."
 
     result = l(opt.image, opt.recognition_only)
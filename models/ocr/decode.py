@@ -0,0 +1,108 @@
+import numpy as np
+
+
+# Helpers for decoding recognizer outputs that only need numpy, so that the
+# onnxruntime recognizer can run without torch installed.
+
+class AttrDict(dict):
+    def __init__(self, *args, **kwargs):
+        super(AttrDict, self).__init__(*args, **kwargs)
+        self.__dict__ = self
+
+def custom_mean(x):
+    "average confidence of a line: product of the per-step max probabilities, length normalized"
+    return x.prod()**(2.0/np.sqrt(len(x)))
+
+class CTCDecoder(object):
+    """ Convert CTC text-index into text-label, without the training-side encoding """
+
+    def __init__(self, character, ignore_idx=(0,)):
+        # character (str or list): set of the possible characters, index 0 is reserved for 'blank'
+        self.character = ['[blank]'] + list(character)
+        self.ignore_idx = list(ignore_idx)
+
+    def decode_greedy(self, text_index, length):
+        """ convert text-index into text-label. """
+        texts = []
+        index = 0
+        for l in length:
+            t = text_index[index:index + l]
+
+            char_list = []
+            for i in range(l):
+                if t[i] not in self.ignore_idx and (not (i > 0 and t[i - 1] == t[i])):  # removing repeated characters and blank (and separator).
+                #if (t[i] != 0) and (not (i > 0 and t[i - 1] == t[i])):  # removing repeated characters and blank (and separator).
+                    char_list.append(self.character[t[i]])
+            text = ''.join(char_list)
+
+            texts.append(text)
+            index += l
+        return texts
+
+def ctc_beam_search(log_probs, beamWidth=8, table=None, accept=None, topk=8, blankIdx=0):
+    """Vectorized CTC prefix beam search in log space.
+
+    log_probs: [T x C] log probabilities of one line.
+    table: optional [S x C] DFA transition table (-1 = character not allowed in that state), state 0 is the start;
+    accept: optional [S] bool array of accepting states.
+    Only the topk characters of each time-step are tried. Returns the best labeling (tuple of indices) and its log probability.
+    """
+    maxT, maxC = log_probs.shape
+    if table is None:
+        table = np.zeros((1, maxC), dtype=np.int64)
+    table = table.copy()
+    table[:, blankIdx] = -1
+    topk = min(topk, maxC)
+
+    # beams are parallel arrays; a labeling is identified by a rolling hash so duplicates can be merged with a sort
+    hashes = np.zeros(1, dtype=np.uint64)
+    prBlank = np.zeros(1)
+    prNonBlank = np.full(1, -np.inf)
+    lastChar = np.full(1, -1)
+    state = np.zeros(1, dtype=np.int64)
+    labelings = [()]
+    prime = np.uint64(1000003)
+
+    for t in range(maxT):
+        mat = log_probs[t]
+        chars = np.argpartition(-mat, topk - 1)[:topk]
+        chars = chars[table[:, chars].max(0) >= 0]
+        prTotal = np.logaddexp(prBlank, prNonBlank)
+        n = len(hashes)
+
+        # keep labeling: paths ending with a blank, or repeating the last char
+        stayBlank = prTotal + mat[blankIdx]
+        stayNonBlank = np.where(lastChar >= 0, prNonBlank + mat[np.maximum(lastChar, 0)], -np.inf)
+
+        # extend labeling by each allowed char; a repeated char must be separated by a blank
+        nextState = table[state][:, chars]    # n x k
+        beam, k = np.nonzero(nextState >= 0)
+        newChar = chars[k]
+        extend = np.where(lastChar[beam] == newChar, prBlank[beam], prTotal[beam]) + mat[newChar]
+
+        allHashes = np.concatenate([hashes, hashes[beam] * prime + (newChar + 1).astype(np.uint64)])
+        allBlank = np.concatenate([stayBlank, np.full(len(beam), -np.inf)])
+        allNonBlank = np.concatenate([stayNonBlank, extend])
+        allLast = np.concatenate([lastChar, newChar])
+        allState = np.concatenate([state, nextState[beam, k]])
+        parent = np.concatenate([np.arange(n), beam])
+        char = np.concatenate([np.full(n, -1), newChar])
+
+        # merge identical labelings reached from different beams
+        order = np.argsort(allHashes, kind="stable")
+        sortedHashes = allHashes[order]
+        starts = np.flatnonzero(np.r_[True, sortedHashes[1:] != sortedHashes[:-1]])
+        mergedBlank = np.logaddexp.reduceat(allBlank[order], starts)
+        mergedNonBlank = np.logaddexp.reduceat(allNonBlank[order], starts)
+
+        best = np.argsort(-np.logaddexp(mergedBlank, mergedNonBlank), kind="stable")[:beamWidth]
+        first = order[starts[best]]
+        hashes, prBlank, prNonBlank = sortedHashes[starts[best]], mergedBlank[best], mergedNonBlank[best]
+        lastChar, state = allLast[first], allState[first]
+        labelings = [labelings[parent[i]] + ((char[i],) if char[i] >= 0 else ()) for i in first]
+
+    prTotal = np.logaddexp(prBlank, prNonBlank)
+    if accept is not None and accept[state].any():
+        prTotal = np.where(accept[state], prTotal, -np.inf)
+    best = int(np.argmax(prTotal))
+    return tuple(int(c) for c in labelings[best]), float(prTotal[best])
@@ -1,7 +1,6 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 
 class Attention(nn.Module):
@@ -16,10 +15,19 @@ class Attention(nn.Module):
     def _char_to_onehot(self, input_char, onehot_dim=38):
         input_char = input_char.unsqueeze(1)
         batch_size = input_char.size(0)
-        one_hot = torch.FloatTensor(batch_size, onehot_dim).zero_().to(device)
+        one_hot = torch.zeros(batch_size, onehot_dim, device=input_char.device)
         one_hot = one_hot.scatter_(1, input_char, 1)
         return one_hot
 
+    def _onehot_table(self, batch_H):
+        # one-hot rows of every class, cached per device and dtype so decoding is a single index lookup.
+        # kept out of the state_dict so that existing checkpoints still load.
+        cache = self.__dict__.setdefault('_onehots', {})
+        key = (batch_H.device, batch_H.dtype)
+        if key not in cache:
+            cache[key] = torch.eye(self.num_classes, device=batch_H.device, dtype=batch_H.dtype)
+        return cache[key]
+
     def forward(self, batch_H, text, is_train=True, batch_max_length=25):
         """
         input:
@@ -30,9 +38,10 @@ class Attention(nn.Module):
         batch_size = batch_H.size(0)
         num_steps = batch_max_length + 1  # +1 for [s] at end of sentence.
 
-        output_hiddens = torch.FloatTensor(batch_size, num_steps, self.hidden_size).fill_(0).to(device)
-        hidden = (torch.FloatTensor(batch_size, self.hidden_size).fill_(0).to(device),
-                  torch.FloatTensor(batch_size, self.hidden_size).fill_(0).to(device))
+        # every buffer follows batch_H, so the module works on whatever device the model was moved to
+        output_hiddens = batch_H.new_zeros(batch_size, num_steps, self.hidden_size)
+        hidden = (batch_H.new_zeros(batch_size, self.hidden_size),
+                  batch_H.new_zeros(batch_size, self.hidden_size))
 
         if is_train:
             for i in range(num_steps):
@@ -44,17 +53,25 @@ class Attention(nn.Module):
             probs = self.generator(output_hiddens)
 
         else:
-            targets = torch.LongTensor(batch_size).fill_(0).to(device)  # [GO] token
-            probs = torch.FloatTensor(batch_size, num_steps, self.num_classes).fill_(0).to(device)
+            onehots = self._onehot_table(batch_H)
+            batch_H_proj = self.attention_cell.i2h(batch_H)  # same for every step
+            targets = torch.zeros(batch_size, dtype=torch.long, device=batch_H.device)  # [GO] token
+            finished = torch.zeros(batch_size, dtype=torch.bool, device=batch_H.device)
+            probs = batch_H.new_zeros(batch_size, num_steps, self.num_classes)
 
             for i in range(num_steps):
-                char_onehots = self._char_to_onehot(targets, onehot_dim=self.num_classes)
-                hidden, alpha = self.attention_cell(hidden, batch_H, char_onehots)
+                char_onehots = onehots[targets]
+                hidden, alpha = self.attention_cell(hidden, batch_H, char_onehots, batch_H_proj)
                 probs_step = self.generator(hidden[0])
                 probs[:, i, :] = probs_step
                 _, next_input = probs_step.max(1)
                 targets = next_input
 
+                # stop once every sequence has emitted [s] (index 1), later steps stay zero
+                finished |= next_input == 1
+                if finished.all():
+                    break
+
         return probs  # batch_size x num_steps x num_classes
 
 
@@ -68,9 +85,10 @@ class AttentionCell(nn.Module):
         self.rnn = nn.LSTMCell(input_size + num_embeddings, hidden_size)
         self.hidden_size = hidden_size
 
-    def forward(self, prev_hidden, batch_H, char_onehots):
+    def forward(self, prev_hidden, batch_H, char_onehots, batch_H_proj=None):
         # [batch_size x num_encoder_step x num_channel] -> [batch_size x num_encoder_step x hidden_size]
-        batch_H_proj = self.i2h(batch_H)
+        if batch_H_proj is None:
+            batch_H_proj = self.i2h(batch_H)
         prev_hidden_proj = self.h2h(prev_hidden[0]).unsqueeze(1)
         e = self.score(torch.tanh(batch_H_proj + prev_hidden_proj))  # batch_size x num_encoder_step * 1
 
@@ -1,13 +1,9 @@
 import torch
 import pickle
 import numpy as np
+from .decode import AttrDict, CTCDecoder, ctc_beam_search
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-class AttrDict(dict):
-    def __init__(self, *args, **kwargs):
-        super(AttrDict, self).__init__(*args, **kwargs)
-        self.__dict__ = self
-
 ##### https://github.com/githubharald/CTCDecoder/blob/master/src/BeamSearch.py
 class BeamEntry:
     "information about one single beam at specific time-step"
@@ -163,6 +159,7 @@ def ctcBeamSearch(mat, classes, ignore_idx, lm, beamWidth=25, dict_list = []):
         res = last.wordsearch(classes, ignore_idx, beamWidth, dict_list)
 
     return res
+
 #####
 
 def consecutive(data, mode ='first', stepsize=1):
@@ -204,7 +201,7 @@ def word_segmentation(mat, separator_idx =  {'th': [1,2],'en': [3,4]}, separator
         result.append( ['', [start_idx, len(mat)-1] ] )
     return result
 
-class CTCLabelConverter(object):
+class CTCLabelConverter(CTCDecoder):
     """ Convert between text-label and text-index """
 
     #def __init__(self, character, separator = []):
@@ -254,23 +251,16 @@ class CTCLabelConverter(object):
 
         return (torch.IntTensor(text), torch.IntTensor(length))
 
-    def decode_greedy(self, text_index, length):
-        """ convert text-index into text-label. """
-        texts = []
-        index = 0
-        for l in length:
-            t = text_index[index:index + l]
-
-            char_list = []
-            for i in range(l):
-                if t[i] not in self.ignore_idx and (not (i > 0 and t[i - 1] == t[i])):  # removing repeated characters and blank (and separator).
-                #if (t[i] != 0) and (not (i > 0 and t[i - 1] == t[i])):  # removing repeated characters and blank (and separator).
-                    char_list.append(self.character[t[i]])
-            text = ''.join(char_list)
-
-            texts.append(text)
-            index += l
-        return texts
+    def decode_greedy_tensor(self, text_index):
+        """ convert a [batch_size x T] tensor of text-index into text-label.
+        repeated characters and blanks are masked out on the device of text_index,
+        only the remaining indices are moved to cpu. """
+        ignore = torch.tensor(self.ignore_idx, device=text_index.device)
+        keep = ~torch.isin(text_index, ignore)
+        keep[:, 1:] &= text_index[:, 1:] != text_index[:, :-1]
+        length = keep.sum(1).cpu().numpy()
+        chars = np.array(self.character, dtype=object)[text_index[keep].cpu().numpy()]
+        return [''.join(c) for c in np.split(chars, np.cumsum(length)[:-1])]
 
     def decode_beamsearch(self, mat, beamWidth=5):
         texts = []
@@ -341,6 +331,15 @@ class AttnLabelConverter(object):
             texts.append(text)
         return texts
 
+    def decode_tensor(self, text_index):
+        """ convert a [batch_size x T] tensor of predicted indices into text-label, cut at the first [s].
+        also returns the number of decoded steps of each row, counting [s]. """
+        end = text_index == 1
+        length = torch.where(end.any(1), end.int().argmax(1), torch.full_like(end[:, 0], end.size(1), dtype=torch.long))
+        text_index, length = text_index.cpu().numpy(), length.cpu().numpy()
+        texts = [''.join([self.character[i] for i in row[:l]]) for row, l in zip(text_index, length)]
+        return texts, np.minimum(length + 1, text_index.shape[1])
+
 
 class Averager(object):
     """Compute average for torch.Tensor, used for loss average."""
@@ -700,6 +700,48 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
     return output
 
 
+def fast_non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, pre_topk=1000,
+                             max_per_class=None, max_det=300):
+    """Inference-only NMS: best class per box, one torchvision batched_nms over the whole batch
+
+    Returns:
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls], sorted by confidence,
+         at most max_per_class boxes per class
+    """
+
+    bs, na, no = prediction.shape
+    nc = no - 5  # number of classes
+
+    # Compute conf, best class only
+    if nc == 1:
+        conf, j = prediction[..., 4], torch.zeros_like(prediction[..., 4], dtype=torch.long)
+    else:
+        conf, j = (prediction[..., 5:] * prediction[..., 4:5]).max(2)
+    if classes is not None:
+        conf = conf * (j[..., None] == torch.tensor(classes, device=j.device)).any(2)
+
+    # Keep the pre_topk most confident boxes of each image
+    conf, idx = conf.topk(min(pre_topk, na), dim=1)
+    j = j.gather(1, idx)
+    x = prediction[..., :4].gather(1, idx[..., None].expand(-1, -1, 4))  # (bs, k, 4)
+    mask = conf > conf_thres
+
+    img = torch.arange(bs, device=x.device)[:, None].expand(-1, x.shape[1])[mask]
+    box, conf, j = xywh2xyxy(x[mask]), conf[mask], j[mask]
+    group = img * nc + j  # one NMS group per (image, class)
+    i = torchvision.ops.batched_nms(box.float(), conf.float(), group, iou_thres)  # sorted by conf
+
+    if max_per_class is not None and i.shape[0]:
+        g, order = group[i].sort(stable=True)  # stable, so each group stays sorted by conf
+        rank = torch.arange(len(g), device=g.device) - torch.searchsorted(g, g)
+        i = i[order[rank < max_per_class]]
+        i = i[conf[i].argsort(descending=True)]  # back to conf order
+
+    det = torch.cat((box[i], conf[i, None], j[i, None].to(box.dtype)), 1)
+    img = img[i]
+    return [det[img == xi][:max_det] for xi in range(bs)]
+
+
 def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
                         labels=(), kpt_label=False, nc=None, nkpt=None):
     """Runs Non-Maximum Suppression (NMS) on inference results
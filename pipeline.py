@@ -0,0 +1,183 @@
+import glob
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+
+import numpy as np
+
+from models.yolo.utils.datasets import img_formats
+from utils import *
+
+
+def list_images(
+    path
+):
+    '''
+    列出目录或glob模式匹配到的全部图片文件。
+    '''
+    p = str(Path(path).absolute())
+    if "*" in p:
+        files = sorted(glob.glob(p, recursive=True))
+    elif os.path.isdir(p):
+        files = sorted(glob.glob(os.path.join(p, "*.*")))
+    elif os.path.isfile(p):
+        files = [p]
+    else:
+        raise FileNotFoundError(f"{p} does not exist.")
+    return [f for f in files if f.split(".")[-1].lower() in img_formats]
+
+def to_record(
+    filename,
+    result
+):
+    '''
+    把Lottery的处理结果转换为可以写入jsonl的dict。
+    '''
+    if isinstance(result, Exception):
+        return {"file": filename, "error": str(result)}
+    if not result:
+        return {"file": filename, "error": "没有检测到彩票信息。"}
+    return {"file": filename, **Result.fromTuple(result).toDict()}
+
+
+class Pipeline:
+    '''
+    流式批量处理：线程池提前完成图片解码和letterbox，
+    有界的预取队列按输入顺序把图片送入推理阶段，推理阶段不会因为解码大图而停顿。
+    reduced_decode时检测后的完整解码由另一个线程池完成。
+    '''
+    def __init__(
+        self,
+        lottery,
+        workers = 4,
+        prefetch = 16,
+        batch_size = 8
+    ):
+        self.lottery = lottery
+        self.workers = workers
+        self.prefetch = max(prefetch, batch_size)
+        self.batch_size = batch_size
+
+    def load(
+        self,
+        filename
+    ):
+        # 在加载线程中执行，cv2解码和缩放时会释放GIL
+        img, source = self.lottery.load(filename)
+        return img, source, self.lottery.detector.resize(img)
+
+    def loaded(
+        self,
+        files,
+        executor
+    ):
+        # 同时在途的加载任务不超过prefetch个，按输入顺序取出
+        files = iter(files)
+        queue = deque((f, executor.submit(self.load, f)) for f in islice(files, self.prefetch))
+        while queue:
+            filename, future = queue.popleft()
+            for f in islice(files, 1):
+                queue.append((f, executor.submit(self.load, f)))
+            try:
+                yield filename, future.result()
+            except Exception as e:
+                yield filename, e
+
+    def detect(
+        self,
+        batch,
+        executor
+    ):
+        '''
+        对一个batch做检测，并把完整解码原图(restore)提交到线程池，返回[(filename, future或异常)]。
+        完整解码与下一个batch的检测同时进行，推理线程不需要等待解码。
+        '''
+        if not batch:
+            return []
+        files, imgs, sources, resized = zip(*batch)
+        detector = self.lottery.detector
+        try:
+            x = detector.to_tensor(np.stack(resized, 0))
+            detections = detector.detect(x, [img.shape for img in imgs])
+        except Exception as e:
+            return [(f, e) for f in files]
+
+        entries = []
+        for f, img, source, detection in zip(files, imgs, sources, detections):
+            try:
+                img, detection, rotation = self.lottery.reorient(img, detection)  # 需要推理，留在当前线程
+            except Exception as e:
+                entries.append((f, e))
+                continue
+            entries.append((f, executor.submit(self.lottery.restore, img, source, detection, rotation)))
+        return entries
+
+    def flush(
+        self,
+        entries,
+        recognition_only = False
+    ):
+        # 逐张取出完整解码的结果，出错的图片只影响自身，其余统一做ocr和开奖查询
+        results = [None] * len(entries)
+        indices, imgs, detections = [], [], []
+        for i, (_, value) in enumerate(entries):
+            try:
+                if isinstance(value, Exception):
+                    raise value
+                img, detection = value.result()
+            except Exception as e:
+                results[i] = e
+                continue
+            indices.append(i)
+            imgs.append(img)
+            detections.append(detection)
+
+        if indices:
+            for i, result in zip(indices, self.lottery.finish(imgs, detections, recognition_only)):
+                results[i] = result
+        yield from zip((filename for filename, _ in entries), results)
+
+    def __call__(
+        self,
+        files,
+        recognition_only = False
+    ):
+        '''
+        按输入顺序逐张yield (filename, result)，result与Lottery.batch相同。
+        letterbox后尺寸相同的相邻图片合并为一个batch送入检测器；
+        一个batch检测完成后先检测下一个batch，再对它做ocr，期间在后台完整解码原图。
+        '''
+        with ThreadPoolExecutor(self.workers) as loader, ThreadPoolExecutor(self.workers) as decoder:
+            batch, pending = [], []
+            for filename, loaded in self.loaded(files, loader):
+                if isinstance(loaded, Exception):
+                    entries = self.detect(batch, decoder) + [(filename, loaded)]
+                    batch = []
+                else:
+                    img, source, resized = loaded
+                    entries = []
+                    if len(batch) == self.batch_size or (batch and batch[-1][3].shape != resized.shape):
+                        entries = self.detect(batch, decoder)
+                        batch = []
+                    batch.append((filename, img, source, resized))
+                if entries:
+                    yield from self.flush(pending, recognition_only)
+                    pending = entries
+            yield from self.flush(pending, recognition_only)
+            yield from self.flush(self.detect(batch, decoder), recognition_only)
+
+    def dump(
+        self,
+        files,
+        output,
+        recognition_only = False
+    ):
+        '''
+        把结果逐行以jsonl格式写入output。
+        '''
+        for filename, result in self(files, recognition_only):
+            output.write(json.dumps(to_record(filename, result), ensure_ascii=False) + "\n")
+            output.flush()
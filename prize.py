@@ -0,0 +1,254 @@
+import argparse
+import json
+import sys
+from math import comb
+
+import numpy as np
+
+from utils import *
+
+
+# 每注号码的红球(前区)、蓝球(后区)个数和号码范围，各奖级对应的(红球命中数, 蓝球命中数)，以及固定奖金
+# 一、二等奖为浮动奖金，默认记为0，需要时通过prizes参数传入当期的奖金
+RULES = {
+    "ssq": {
+        "red": 6,
+        "blue": 1,
+        "range": (33, 16),
+        "tiers": {
+            1: [(6, 1)],
+            2: [(6, 0)],
+            3: [(5, 1)],
+            4: [(5, 0), (4, 1)],
+            5: [(4, 0), (3, 1)],
+            6: [(2, 1), (1, 1), (0, 1)]
+        },
+        "prizes": {1: 0, 2: 0, 3: 3000, 4: 200, 5: 10, 6: 5}
+    },
+    "cjdlt": {
+        "red": 5,
+        "blue": 2,
+        "range": (35, 12),
+        "tiers": {
+            1: [(5, 2)],
+            2: [(5, 1)],
+            3: [(5, 0)],
+            4: [(4, 2)],
+            5: [(4, 1)],
+            6: [(3, 2)],
+            7: [(4, 0)],
+            8: [(3, 1), (2, 2)],
+            9: [(3, 0), (2, 1), (1, 2), (0, 2)]
+        },
+        "prizes": {1: 0, 2: 0, 3: 10000, 4: 3000, 5: 300, 6: 200, 7: 100, 8: 15, 9: 5}
+    }
+}
+
+BINOM = np.array([[comb(n, k) for k in range(64)] for n in range(64)], dtype=np.int64)
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+
+def tier_matrix(code):
+    '''
+    (红球命中数 x 蓝球命中数, 奖级数+1)的one-hot矩阵，第0列为未中奖。
+    '''
+    rule = RULES[code]
+    shape = (rule["red"] + 1, rule["blue"] + 1)
+    table = np.zeros(shape, dtype=np.int64)
+    for tier, hits in rule["tiers"].items():
+        for hit in hits:
+            table[hit] = tier
+    return np.eye(len(rule["tiers"]) + 1, dtype=np.int64)[table.ravel()]
+
+TIER_MATRIX = {code: tier_matrix(code) for code in RULES}
+
+
+def popcount(x):
+    '''
+    逐元素统计uint64数组中为1的位数。
+    '''
+    x = np.ascontiguousarray(x, dtype=np.uint64)
+    return POPCOUNT[x.view(np.uint8)].reshape(x.shape + (8,)).sum(-1)
+
+def binom(n, k):
+    '''
+    逐元素计算组合数C(n, k)，k < 0或k > n时为0。
+    '''
+    n, k = np.broadcast_arrays(n, k)
+    valid = (k >= 0) & (k <= n) & (n >= 0)
+    return np.where(valid, BINOM[n.clip(0, 63), k.clip(0, 63)], 0)
+
+def check_range(numbers, limit):
+    '''
+    号码必须在1到limit之间，例如漏识别空格得到的"0304"，超出范围时抛出MissingInfoException。
+    '''
+    for num in numbers:
+        if not str(num).isdigit() or not 1 <= int(num) <= limit:
+            raise MissingInfoException(f"号码{num}超出范围1-{limit}，请检查识别结果。")
+    return numbers
+
+def encode(numbers):
+    '''
+    把number_process的结果编码为(n, 4)的bitmask数组，各列依次为红胆、红拖、蓝胆、蓝拖。
+    单式和复式没有胆码，全部号码记为拖码。
+    '''
+    red, blue = RULES[numbers["code"]]["range"]
+    rows = []
+    for number in numbers["numbers"]:
+        if numbers["game_type"] == "complex":
+            red_required, red_optional, blue_required, blue_optional = number
+        else:
+            red_required, blue_required = [], []
+            red_optional, blue_optional = number
+        groups = (check_range(red_required, red), check_range(red_optional, red), check_range(blue_required, blue), check_range(blue_optional, blue))
+        rows.append([to_mask(group) for group in groups])
+    return np.array(rows, dtype=np.uint64).reshape(-1, 4)
+
+def hit_distribution(required, required_hit, optional, optional_hit, pick):
+    '''
+    每注从全部胆码和(pick - 胆码数)个拖码组成，统计展开后命中k个号码的注数，返回(n, pick + 1)。
+    胆码全部入选，所以命中k个时需要从拖码的命中号码中选出k - required_hit个，其余从未命中的拖码中选。
+    '''
+    k = np.arange(pick + 1)[None, :]
+    choose = (pick - required)[:, None]
+    j = k - required_hit[:, None]
+    return binom(optional_hit[:, None], j) * binom((optional - optional_hit)[:, None], choose - j)
+
+def tier_counts(code, masks, winning):
+    '''
+    masks为encode的结果，返回(n, 奖级数+1)的数组：每一行号码展开全部组合后，各奖级的中奖注数，第0列为未中奖注数。
+    复式、胆拖不需要逐注枚举，按组合数直接计算。
+    '''
+    rule = RULES[code]
+    red_win, blue_win = to_mask(winning[0]), to_mask(winning[1])
+    masks = np.asarray(masks, dtype=np.uint64).reshape(-1, 4)
+
+    size = popcount(masks)
+    hit = popcount(masks & np.array([red_win, red_win, blue_win, blue_win], dtype=np.uint64))
+
+    red = hit_distribution(size[:, 0], hit[:, 0], size[:, 1], hit[:, 1], rule["red"])
+    blue = hit_distribution(size[:, 2], hit[:, 2], size[:, 3], hit[:, 3], rule["blue"])
+
+    combos = (red[:, :, None] * blue[:, None, :]).reshape(len(masks), -1)
+    return combos @ TIER_MATRIX[code]
+
+def payout(code, counts, prizes=None):
+    '''
+    按各奖级注数计算奖金，prizes可以覆盖默认奖金（例如当期一、二等奖的浮动奖金）。
+    '''
+    amounts = dict(RULES[code]["prizes"])
+    if prizes:
+        amounts.update(prizes)
+    amounts = np.array([0] + [amounts[tier] for tier in sorted(RULES[code]["tiers"])], dtype=np.int64)
+    return np.asarray(counts) @ amounts
+
+def prize_check(numbers, winning, prizes=None):
+    '''
+    计算一张彩票每行号码的各奖级中奖注数和奖金。
+    '''
+    code = numbers["code"]
+    counts = tier_counts(code, encode(numbers), winning)
+    return counts, payout(code, counts, prizes)
+
+def encode_batch(tickets):
+    '''
+    把多张彩票(number_process结果的list)编码为列式数组：全部号码行的bitmask，以及每一行所属彩票的序号。
+    逐张编码，编码失败的彩票不占用号码行，errors中对应位置为异常，其余为None。
+    '''
+    masks, errors = [], []
+    for ticket in tickets:
+        try:
+            masks.append(encode(ticket))
+            errors.append(None)
+        except Exception as e:
+            masks.append(np.zeros((0, 4), dtype=np.uint64))
+            errors.append(e)
+    owner = np.repeat(np.arange(len(masks)), [len(m) for m in masks])
+    masks = np.concatenate(masks) if masks else np.zeros((0, 4), dtype=np.uint64)
+    return masks, owner, errors
+
+def batch_prize_check(tickets, winning, prizes=None):
+    '''
+    用同一期的开奖号码对多张同类彩票统一计算，返回每张彩票各奖级的中奖注数(m, 奖级数+1)、奖金(m,)，以及每张彩票的异常。
+    一张彩票出错不影响其他彩票，它的中奖注数和奖金为0。
+    '''
+    codes = {ticket["code"] for ticket in tickets}
+    assert len(codes) <= 1, "All tickets should be of the same lottery."
+    code = codes.pop() if codes else "ssq"
+
+    masks, owner, errors = encode_batch(tickets)
+    counts = tier_counts(code, masks, winning)
+    ticket_counts = np.zeros((len(tickets), counts.shape[1]), dtype=np.int64)
+    np.add.at(ticket_counts, owner, counts)
+    return ticket_counts, payout(code, ticket_counts, prizes), errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--issue", type=str, default=None, help="only score tickets of this issue")
+    parser.add_argument("--winning", type=str, default=None, help="winning numbers, e.g. \"01 02 03 04 05 06 + 07\", queried if omitted")
+    parser.add_argument("--prize", type=str, action="append", default=[], help="prize of a tier, e.g. 1=5000000, can be repeated")
+    parser.add_argument("--cert_", type=str, default="./cert_.txt", help="API infomation")
+    parser.add_argument("--cache_", type=str, default="./checkouts/draws.db", help="sqlite file caching winning numbers")
+    parser.add_argument("--index_dir", type=str, default="./checkouts/draws", help="directory of offline draw indexes")
+    parser.add_argument("--output", type=str, default=None, help="jsonl file for results, stdout by default")
+    parser.add_argument("results", type=str, help="jsonl file of recognition results")
+
+    opt = parser.parse_args()
+
+    prizes = {int(tier): int(amount) for tier, amount in (p.split("=") for p in opt.prize)}
+
+    def error_record(record, e):
+        return {"file": record.get("file"), "error": str(e)}
+
+    output = open(opt.output, "w", encoding="utf-8") if opt.output else sys.stdout
+    groups = {}
+    with open(opt.results, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if "error" in record:
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                continue
+            if opt.issue and record.get("issue") != opt.issue:
+                continue
+            groups.setdefault((record.get("code"), record.get("issue")), []).append(record)
+
+    checker = None
+    for (code, issue), records in groups.items():
+        try:
+            if opt.winning:
+                winning = winning_process(opt.winning, code)
+            else:
+                if checker is None:
+                    from checker import Checker
+                    checker = Checker.from_file(opt.cert_, cache=opt.cache_, index_dir=opt.index_dir)
+                winning = checker.query(code, issue)
+        except Exception as e:
+            # 期号缺失、尚未开奖或查询失败时，这一期的彩票都记为出错，继续处理其他期
+            for record in records:
+                output.write(json.dumps(error_record(record, e), ensure_ascii=False) + "\n")
+            continue
+
+        tickets, valid = [], []
+        for record in records:
+            try:
+                tickets.append(Result.fromDict(record).toTuple()[2])
+                valid.append(record)
+            except Exception as e:
+                output.write(json.dumps(error_record(record, e), ensure_ascii=False) + "\n")
+
+        counts, amounts, errors = batch_prize_check(tickets, winning, prizes)
+        for record, count, amount, error in zip(valid, counts, amounts, errors):
+            if error is not None:
+                output.write(json.dumps(error_record(record, error), ensure_ascii=False) + "\n")
+                continue
+            output.write(json.dumps({
+                "file": record.get("file"),
+                "code": code,
+                "issue": issue,
+                "winning": winning,
+                "tiers": count[1:].tolist(),
+                "payout": int(amount)
+            }, ensure_ascii=False) + "\n")
+    if output is not sys.stdout:
+        output.close()
@@ -0,0 +1,150 @@
+import logging
+import threading
+from collections import Counter
+
+import cv2
+import numpy as np
+
+from utils import *
+
+log = logging.getLogger(__name__)
+
+
+QUALITY_MODES = ("off", "flag", "reject")
+REASONS = {
+    "small": "分辨率太低",
+    "blurry": "图片模糊",
+    "dark": "图片过暗",
+    "bright": "图片过亮"
+}
+
+
+class QualityGate:
+    '''
+    在运行模型之前检查图片质量：分辨率、清晰度（拉普拉斯方差）和曝光。
+    清晰度在图片中心及四周的几个tile×tile小块上按原始像素尺度计算，取最大值，结果不随图片尺寸变化
+    （reduced_decode时为缩小解码后的像素尺度，长边在640到1280之间）；
+    曝光在按步长取样到长边约为size的灰度图上计算。两者都只访问很少的像素，大图也只需要几毫秒。
+    mode为flag时只记录，为reject时抛出LowQualityException。
+    '''
+    def __init__(
+        self,
+        mode = "off",
+        min_size = 240,
+        min_sharpness = 15.0,
+        dark_level = 30,
+        max_dark = 0.9,
+        bright_level = 225,
+        max_bright = 0.9,
+        size = 256,
+        tile = 256
+    ):
+        assert mode in QUALITY_MODES, f"Quality mode {mode} is illegal."
+        self.mode = mode
+        self.min_size = min_size
+        self.min_sharpness = min_sharpness
+        self.dark_level = dark_level
+        self.max_dark = max_dark
+        self.bright_level = bright_level
+        self.max_bright = max_bright
+        self.size = size
+        self.tile = tile
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def gray(img):
+        img = np.ascontiguousarray(img)
+        return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+
+    def downsample(
+        self,
+        img
+    ):
+        # 按步长取样到长边约为size，只访问很少的像素，不对整张大图做缩放和颜色转换
+        step = max(1, max(img.shape[:2]) // self.size)
+        return self.gray(img[::step, ::step])
+
+    def tiles(
+        self,
+        img
+    ):
+        # 中心以及上下左右四分之一处的小块，彩票文字一般会落在其中几块里
+        h, w = img.shape[:2]
+        t = min(self.tile, h, w)
+        for cy, cx in ((h // 2, w // 2), (h // 4, w // 2), (h * 3 // 4, w // 2), (h // 2, w // 4), (h // 2, w * 3 // 4)):
+            y = min(max(cy - t // 2, 0), h - t)
+            x = min(max(cx - t // 2, 0), w - t)
+            yield self.gray(img[y : y + t, x : x + t])
+
+    def sharpness(
+        self,
+        img
+    ):
+        '''
+        原始像素尺度下的拉普拉斯方差，取各个小块中的最大值，避免空白区域拉低结果。
+        '''
+        return max(float(cv2.Laplacian(tile, cv2.CV_64F).var()) for tile in self.tiles(img))
+
+    def measure(
+        self,
+        img,
+        scale = 1
+    ):
+        '''
+        返回短边像素数、拉普拉斯方差、过暗和过亮像素的占比。scale为img相对原图的缩小倍数。
+        '''
+        gray = self.downsample(img)
+        hist = np.bincount(gray.ravel(), minlength=256) / gray.size
+        return {
+            "size": min(img.shape[:2]) * scale,
+            "sharpness": self.sharpness(img),
+            "dark": float(hist[: self.dark_level].sum()),
+            "bright": float(hist[self.bright_level :].sum())
+        }
+
+    def check(
+        self,
+        img,
+        scale = 1
+    ):
+        '''
+        返回未通过的检查项list，全部通过时为空list。
+        '''
+        m = self.measure(img, scale)
+        reasons = []
+        if m["size"] < self.min_size:
+            reasons.append("small")
+        if m["sharpness"] < self.min_sharpness:
+            reasons.append("blurry")
+        if m["dark"] > self.max_dark:
+            reasons.append("dark")
+        if m["bright"] > self.max_bright:
+            reasons.append("bright")
+        return reasons
+
+    def __call__(
+        self,
+        img,
+        scale = 1
+    ):
+        if self.mode == "off":
+            return []
+        reasons = self.check(img, scale)
+        with self.lock:
+            self.counters["checked"] += 1
+            self.counters.update(reasons)
+            if reasons:
+                self.counters["flagged" if self.mode == "flag" else "rejected"] += 1
+        if not reasons:
+            return reasons
+
+        message = "图片质量不满足要求：" + "、".join(REASONS[r] for r in reasons) + "，请调整后重试。"
+        if self.mode == "reject":
+            raise LowQualityException(reasons, message)
+        log.warning(message)
+        return reasons
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
@@ -1,9 +1,44 @@
-from PIL import Image
-import torch
-from torch.utils.data import DataLoader
-from torch.nn.functional import softmax
+import json
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+
+import cv2
+import numpy as np
+
+# torch只在torch后端中导入，onnxruntime后端只依赖numpy、cv2和onnxruntime
+from models.ocr.decode import AttrDict, CTCDecoder, custom_mean, ctc_beam_search
+from grammar import ANY
+
+log = logging.getLogger(__name__)
+
+
+BACKENDS = ("torch", "onnxruntime")
+QUANTIZE_MODES = ("none", "dynamic")
+
+
+def quantize_dynamic(
+    model
+    ):
+    '''
+    把BiLSTM和CTC输出层的权重转换为int8，激活在推理时动态量化，只能在cpu上运行。
+    '''
+    import torch
+    import torch.nn as nn
+
+    return torch.quantization.quantize_dynamic(model.cpu().eval(), {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+
+def is_quantized(
+    model
+    ):
+    '''
+    模型中是否有动态量化的模块，例如export.py quantize-recognizer保存的模型。
+    '''
+    return any(".quantized" in type(m).__module__ for m in model.modules())
 
-from utils import *
 
 class Recognizer:
 
@@ -11,59 +46,259 @@ class Recognizer:
         self,
         model_file,
         device = "cpu",
+        batch_size = 32,
+        backend = "torch",
+        quantize = "none",
+        width_buckets = None,
+        beam_threshold = None,
+        beam_width = 8
         ):
-        weights = torch.load(model_file)
-        self.model = weights["model"]
-        self.converter = weights["converter"]
-        self.opt = self.model.opt
+        assert backend in BACKENDS, f"Backend {backend} is illegal."
+        assert quantize in QUANTIZE_MODES, f"Quantize mode {quantize} is illegal."
+        assert quantize == "none" or backend == "torch", "Quantization is only supported by torch backend."
+        self.backend = backend
+        self.device = device
+        self.batch_size = batch_size
+        self.beam_threshold = beam_threshold
+        self.beam_width = beam_width
+
+        if backend == "onnxruntime":
+            self.init_onnxruntime(model_file)
+        else:
+            import torch
+
+            weights = torch.load(model_file)
+            self.model = weights["model"]
+            self.converter = weights["converter"]
+            self.opt = self.model.opt
+
+            if quantize == "dynamic":
+                self.model = quantize_dynamic(self.model)
+            if is_quantized(self.model):
+                # 动态量化的模块只能在cpu上运行，包括提前量化保存的模型
+                if str(device) != "cpu":
+                    log.warning(f"Quantized recognizer can only run on cpu, ignoring device {device}.")
+                self.device = device = "cpu"
+
+            _ = self.model.to(device)
+            self.model.eval()
+
+        self.attention = self.opt.Prediction == "Attn"
+        assert not (self.attention and beam_threshold is not None), "Beam search is only supported by CTC recognizer."
+
         self.imgH = self.opt.imgH
         self.imgW = self.opt.imgW
         self.input_channel = self.opt.input_channel
-        self.device = device
 
-        _ = self.model.to(device)
-        self.model.eval()
+        # 宽度分组：按imgW的比例取几个宽度（4的倍数），每张裁切图只padding到不小于自身宽度的最小分组
+        self.widths = [self.imgW]
+        if width_buckets:
+            self.widths = sorted({min(self.imgW, math.ceil(self.imgW * r / 4) * 4) for r in width_buckets} | {self.imgW})
+        self.local = threading.local()     # 每个线程各自复用的输入，见buffer
+        self.timings = defaultdict(lambda: {"batches": 0, "crops": 0, "seconds": 0., "beams": 0})
 
-    def __call__(
+    def init_onnxruntime(
         self,
-        imgs
+        model_file
         ):
-        results = []
-        transform = NormalizePAD((self.input_channel, self.imgH, self.imgW))
-        with torch.no_grad():
-            for img in imgs:
-                img = Image.fromarray(img).convert("L")
-                w, h = img.size
-               
-                ratio = w / float(h)
-                if math.ceil(self.imgH * ratio) > self.imgW:
-                    resized_w = self.imgW
-                else:
-                    resized_w = math.ceil(self.imgH * ratio)
+        # 由export.py导出，batch和宽度维度可变，字符集等参数保存在onnx的metadata中
+        import onnxruntime as ort
 
-                img = img.resize((resized_w, self.imgH), Image.BICUBIC)
-                img = transform(img)
-                img = img.unsqueeze(0)
-                img = img.to(self.device)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(str(model_file), options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
 
-                text_for_pred = torch.LongTensor(1, w // 10 + 1).fill_(0).to(self.device)
+        meta = self.session.get_modelmeta().custom_metadata_map
+        self.opt = AttrDict(json.loads(meta["opt"]))
+        self.converter = CTCDecoder(json.loads(meta["character"]), json.loads(meta["ignore_idx"]))
+        self.device = "cpu"
 
-                preds = self.model(img, text_for_pred)
+    def resize(
+        self,
+        img
+        ):
+        # img为utils.crop返回的view，直接转灰度并resize为imgH高的uint8数组
+        # 与原来PIL的convert("L")一致，按RGB的权重转灰度；缩小用INTER_AREA，放大用INTER_CUBIC
+        h, w = img.shape[:2]
 
-                preds_size = [preds.size(1)]
+        ratio = w / float(h)
+        if math.ceil(self.imgH * ratio) > self.imgW:
+            resized_w = self.imgW
+        else:
+            resized_w = math.ceil(self.imgH * ratio)
 
-                preds_prob = softmax(preds, dim=-1).squeeze().cpu().detach().numpy()
+        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY) if img.ndim == 3 else img
+        interpolation = cv2.INTER_AREA if h > self.imgH else cv2.INTER_CUBIC
+        return cv2.resize(gray, (resized_w, self.imgH), interpolation=interpolation)
 
-                values = preds_prob.max(axis=-1)
-                indices = preds_prob.argmax(axis=-1)
+    def bucket(
+        self,
+        width
+        ):
+        return next(w for w in self.widths if w >= width)
 
-                preds_str = self.converter.decode_greedy(indices.ravel(), preds_size)[0]
-                confidence_score = custom_mean(values)
+    def buffer(
+        self,
+        n,
+        width
+        ):
+        '''
+        每个宽度分组复用一块[batch_size, input_channel, imgH, width]的输入，返回前n张的切片。
+        torch后端在cuda上推理时使用锁页内存，便于异步拷贝。
+        输入按线程分别保存，多个线程同时调用同一个Recognizer时不会写入同一块内存。
+        '''
+        buffers = self.local.__dict__.setdefault("buffers", {})
+        if width not in buffers:
+            shape = (self.batch_size, self.input_channel, self.imgH, width)
+            if self.backend == "onnxruntime":
+                buffers[width] = np.empty(shape, dtype=np.float32)
+            else:
+                import torch
 
-                results.append([preds_str, confidence_score])
+                buffers[width] = torch.empty(shape, pin_memory=torch.device(self.device).type == "cuda")
+        return buffers[width][:n]
 
-        return results
+    def pad(
+        self,
+        img,
+        out
+        ):
+        # img为resize后的uint8灰度图，归一化到[-1, 1]后写入out(c x h x width)，右侧用最后一列填充
+        w = img.shape[1]
+        np.multiply(img, 2 / 255.0, out=out[:, :, :w], casting="unsafe")
+        out[:, :, :w] -= 1
+        out[:, :, w:] = out[:, :, w - 1 : w]
+        return out
+
+    def beam_search(
+        self,
+        log_probs,
+        grammar = None
+        ):
+        '''
+        在一行的log概率矩阵上做限定字符集和行格式的beam search，返回识别结果和按custom_mean同样方式计算的confidence。
+        '''
+        table, accept = (grammar or ANY).compile(self.converter.character)
+        labeling, score = ctc_beam_search(log_probs, self.beam_width, table, accept)
+        text = "".join(self.converter.character[c] for c in labeling if c not in self.converter.ignore_idx)
+        return text, math.exp(score * 2.0 / math.sqrt(len(log_probs)))
+
+    def rescore(
+        self,
+        preds_str,
+        confidences,
+        log_probs,
+        grammars = None,
+        width = None
+        ):
+        # 只对greedy confidence低于beam_threshold的行做beam search，log_probs只取这些行
+        if self.beam_threshold is None:
+            return preds_str, confidences
+        low = np.flatnonzero(confidences < self.beam_threshold)
+        if not len(low):
+            return preds_str, confidences
+
+        log_probs = log_probs(low)
+        confidences = confidences.copy()
+        for i, row in zip(low, log_probs):
+            preds_str[i], confidences[i] = self.beam_search(row, grammars[i] if grammars else None)
+        self.timings[width or self.imgW]["beams"] += len(low)
+        return preds_str, confidences
+
+    def inference(
+        self,
+        imgs,
+        width = None,
+        grammars = None
+        ):
+        '''
+        对一个batch已经resize的图片padding到width后做一次前向计算和greedy解码，返回识别结果list和confidence数组。
+        设置了beam_threshold时，confidence低的行再按grammars中对应的行格式做beam search。
+        '''
+        width = width or self.imgW
+        batch = self.buffer(len(imgs), width)
+        array = batch if self.backend == "onnxruntime" else batch.numpy()
+        for img, out in zip(imgs, array):
+            self.pad(img, out)
+
+        if self.backend == "onnxruntime":
+            preds = self.session.run(None, {self.input_name: batch})[0]
+            preds = np.exp(preds - preds.max(axis=-1, keepdims=True))
+            preds_prob = preds / preds.sum(axis=-1, keepdims=True)    # n x t x c
 
+            values, indices = preds_prob.max(axis=-1), preds_prob.argmax(axis=-1)
+            preds_str = self.converter.decode_greedy(indices.ravel(), [indices.shape[1]] * len(indices))
+            confidences = np.array([custom_mean(value) for value in values])
+            return self.rescore(preds_str, confidences, lambda low: np.log(preds_prob[low]), grammars, width)
 
+        import torch
+        from torch.nn.functional import softmax, log_softmax
 
+        batch = batch.to(self.device, non_blocking=True)
+        n = batch.size(0)
+
+        text_for_pred = torch.LongTensor(n, self.opt.batch_max_length + 1).fill_(0).to(self.device)
+
+        with torch.no_grad():
+            preds = self.model(batch, text_for_pred, is_train=False)
+
+        if self.attention:
+            # 逐步解码到所有行都输出[s]为止，每行只取[s]之前的字符，confidence按包括[s]在内的步数计算
+            values, indices = softmax(preds, dim=-1).max(dim=-1)
+            preds_str, length = self.converter.decode_tensor(indices)
+            length = torch.from_numpy(length).to(values.device)
+            steps = torch.arange(values.size(1), device=values.device)
+            values = torch.where(steps[None] < length[:, None], values, torch.ones_like(values))
+            confidences = values.prod(dim=1).pow(2.0 / length.float().sqrt())
+            return preds_str, confidences.cpu().numpy()
+
+        # 在device上完成argmax、去重复和blank，只把剩下的字符序号和每行的confidence传回cpu
+        values, indices = softmax(preds, dim=-1).max(dim=-1)    # n x t
+        preds_str = self.converter.decode_greedy_tensor(indices)
+        confidences = values.prod(dim=1).pow(2.0 / math.sqrt(values.size(1)))    # 与custom_mean相同
+        low_probs = lambda low: log_softmax(preds[torch.from_numpy(low).to(preds.device)], dim=-1).cpu().numpy()
+        return self.rescore(preds_str, confidences.cpu().numpy(), low_probs, grammars, width)
+
+    def __call__(
+        self,
+        imgs,
+        grammars = None
+        ):
+        # imgs可以是一张或多张彩票的全部裁切图，按宽度分组后再按batch_size分批，每批只做一次前向计算
+        # grammars与imgs一一对应，为每张裁切图的行格式，只在beam search时使用
+        resized = [self.resize(img) for img in imgs]
+        groups = defaultdict(list)
+        for i, img in enumerate(resized):
+            groups[self.bucket(img.shape[1])].append(i)
+
+        results = [None] * len(imgs)
+        for width, group in groups.items():
+            for i in range(0, len(group), self.batch_size):
+                chunk = group[i : i + self.batch_size]
+                start = time.perf_counter()
+                chunk_grammars = [grammars[j] for j in chunk] if grammars else None
+                preds_str, confidences = self.inference([resized[j] for j in chunk], width, chunk_grammars)
+                for j, text, confidence in zip(chunk, preds_str, confidences):
+                    results[j] = [text, confidence]
+
+                timing = self.timings[width]
+                timing["batches"] += 1
+                timing["crops"] += len(chunk)
+                timing["seconds"] += time.perf_counter() - start
+
+        return results
 
+    def stats(self):
+        '''
+        各宽度分组的batch数、裁切图数、平均每张裁切图的耗时（包括beam search）和做了beam search的行数，
+        用于调整分组宽度和beam_threshold。
+        '''
+        return {
+            width: {
+                "batches": t["batches"],
+                "crops": t["crops"],
+                "ms_per_crop": t["seconds"] * 1000 / max(t["crops"], 1),
+                "beam_searches": t["beams"]
+            } for width, t in sorted(self.timings.items())
+        }
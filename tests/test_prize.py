@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+from prize import batch_prize_check, encode, prize_check
+from utils import MissingInfoException
+
+
+def ticket(code, game_type, *numbers):
+    return {"code": code, "game_type": game_type, "numbers": list(numbers)}
+
+def numbers(string):
+    return string.split()
+
+
+def test_ssq_single():
+    counts, amounts = prize_check(
+        ticket("ssq", "single", (numbers("01 02 03 04 05 06"), ["07"])),
+        (numbers("01 02 03 04 10 11"), ["07"])
+    )
+    # 4+1为四等奖
+    assert counts.tolist() == [[0, 0, 0, 0, 1, 0, 0]]
+    assert amounts.tolist() == [200]
+
+def test_ssq_compound():
+    counts, amounts = prize_check(
+        ticket("ssq", "compound", (numbers("01 02 03 04 05 06 07"), ["07"])),
+        (numbers("01 02 03 04 05 06"), ["07"]),
+        prizes={1: 5000000}
+    )
+    # 7+1展开为7注：1注6+1，6注5+1
+    assert counts.tolist() == [[0, 1, 0, 6, 0, 0, 0]]
+    assert amounts.tolist() == [5000000 + 6 * 3000]
+
+def test_ssq_complex():
+    counts, amounts = prize_check(
+        ticket("ssq", "complex", (["01", "02"], numbers("03 04 05 06 07 08"), [], ["07"])),
+        (numbers("01 02 03 04 20 21"), ["07"])
+    )
+    # 2胆6拖展开为C(6, 4) = 15注，胆码全中，拖码中2个
+    assert counts.tolist() == [[0, 0, 0, 0, 6, 8, 1]]
+    assert amounts.tolist() == [6 * 200 + 8 * 10 + 5]
+
+def test_cjdlt_blue_required():
+    counts, amounts = prize_check(
+        ticket("cjdlt", "complex", ([], numbers("01 02 03 04 05"), ["01"], numbers("02 03 04"))),
+        (numbers("01 02 03 04 05"), ["01", "02"]),
+        prizes={1: 10000000, 2: 200000}
+    )
+    # 后区1胆3拖展开为3注：1注5+2，2注5+1
+    assert counts.tolist() == [[0, 1, 2, 0, 0, 0, 0, 0, 0, 0]]
+    assert amounts.tolist() == [10000000 + 2 * 200000]
+
+@pytest.mark.parametrize("code, number", [
+    ("ssq", (numbers("0304 05 06 07 08 09"), ["10"])),
+    ("ssq", (numbers("01 02 03 04 05 34"), ["10"])),
+    ("ssq", (numbers("01 02 03 04 05 06"), ["17"])),
+    ("ssq", (numbers("00 02 03 04 05 06"), ["10"])),
+    ("cjdlt", (numbers("01 02 03 04 36"), ["01", "02"])),
+    ("cjdlt", (numbers("01 02 03 04 05"), ["01", "13"]))
+])
+def test_out_of_range(code, number):
+    with pytest.raises(MissingInfoException):
+        encode(ticket(code, "single", number))
+
+def test_encode():
+    masks = encode(ticket("ssq", "single", (numbers("01 02 03 04 05 33"), ["16"])))
+    assert masks.dtype == np.uint64
+    assert masks.tolist() == [[0, 0b111110 | 1 << 33, 0, 1 << 16]]
+
+def test_batch_errors():
+    tickets = [
+        ticket("ssq", "single", (numbers("01 02 03 04 05 06"), ["07"])),
+        ticket("ssq", "single", (numbers("0304 05 06 07 08 09"), ["10"])),
+        ticket("ssq", "compound", (numbers("01 02 03 04 05 06 07"), ["07"]))
+    ]
+    counts, amounts, errors = batch_prize_check(tickets, (numbers("01 02 03 04 05 06"), ["07"]), prizes={1: 5000000})
+    # 出错的彩票不影响同一批的其他彩票
+    assert errors[0] is None and errors[2] is None
+    assert isinstance(errors[1], MissingInfoException)
+    assert counts.tolist() == [[0, 1, 0, 0, 0, 0, 0], [0] * 7, [0, 1, 0, 6, 0, 0, 0]]
+    assert amounts.tolist() == [5000000, 0, 5000000 + 6 * 3000]
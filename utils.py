@@ -1,16 +1,15 @@
-import math
 import re
 import logging
 from dataclasses import dataclass
 
-from natsort import natsort_key
 import cv2
 import numpy as np
-import torch
-from torchvision import transforms
+from PIL import Image
 from PyQt5 import QtCore
 from PyQt5.QtCore import Qt
 
+from models.ocr.decode import AttrDict, custom_mean     # 不依赖torch，供onnxruntime推理使用
+
 log = logging.getLogger(__name__)
 
 
@@ -30,6 +29,39 @@ def imread(
         print(e)
         return
 
+REDUCED_FLAGS = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+def reduced_flag(
+    filename,
+    size = 640
+):
+    '''
+    只读取文件头中的图片尺寸，选择cv2的缩小解码方式，保证缩小后的长边不小于size，返回(flag, 缩小倍数)。
+    '''
+    try:
+        with Image.open(filename) as img:
+            long_edge = max(img.size)
+    except Exception:
+        return cv2.IMREAD_COLOR, 1
+    for factor in (8, 4, 2):
+        if long_edge / factor >= size:
+            return REDUCED_FLAGS[factor], factor
+    return cv2.IMREAD_COLOR, 1
+
+def scale_boxes(
+    boxes,
+    shape,
+    new_shape
+):
+    '''
+    把[x1, y1, x2, y2, ...]格式的box从尺寸为shape的图片映射到尺寸为new_shape的图片。
+    '''
+    boxes = boxes.copy()
+    sy, sx = new_shape[0] / shape[0], new_shape[1] / shape[1]
+    boxes[..., [0, 2]] = (boxes[..., [0, 2]] * sx).round().clip(0, new_shape[1])
+    boxes[..., [1, 3]] = (boxes[..., [1, 3]] * sy).round().clip(0, new_shape[0])
+    return boxes
+
 def sort_box(
     boxes
 ):
@@ -52,40 +84,6 @@ def crop(
         results.append(img[xyxy[1] : xyxy[3], xyxy[0] : xyxy[2], :])
     return results
 
-class NormalizePAD:
-    '''
-    对进入recognizer进行ocr识别的图片进行padding等预处理。
-    '''
-    def __init__(self, max_size, PAD_type='right'):
-        self.toTensor = transforms.ToTensor()
-        self.max_size = max_size
-        self.PAD_type = PAD_type
-
-    def __call__(self, img):
-        img = self.toTensor(img)
-        img.sub_(0.5).div_(0.5)
-        c, h, w = img.size()
-        Pad_img = torch.FloatTensor(*self.max_size).fill_(0)
-        Pad_img[:, :, :w] = img  # right pad
-        if self.max_size[2] != w:  # add border Pad
-            Pad_img[:, :, w:] = img[:, :, w - 1].unsqueeze(2).expand(c, h, self.max_size[2] - w)
-
-        return Pad_img
-
-def custom_mean(x):
-    '''
-    计算ocr的平均confidence score。
-    '''
-    return x.prod()**(2.0/np.sqrt(len(x)))
-
-class AttrDict(dict):
-    '''
-    保存模型参数。
-    '''
-    def __init__(self, *args, **kwargs):
-        super(AttrDict, self).__init__(*args, **kwargs)
-        self.__dict__ = self
-
 def number_process(numbers, code):
     '''
     彩票号码前处理。
@@ -204,6 +202,14 @@ class MissingInfoException(Exception):
     def __init__(self, *args):
         super().__init__(*args)
 
+class LowQualityException(MissingInfoException):
+    '''
+    图片分辨率、清晰度或曝光不满足要求，reasons为未通过的检查项。
+    '''
+    def __init__(self, reasons, *args):
+        super().__init__(*args)
+        self.reasons = reasons
+
 
 def issue_process(issue_string):
     '''
@@ -230,29 +236,45 @@ def winning_process(winning_number, code):
         blue = matched[5 : 7]
     return red, blue
 
+def to_mask(numbers):
+    '''
+    号码list转换为bitmask，第n位为1表示包含号码n。
+    '''
+    mask = 0
+    for num in numbers:
+        mask |= 1 << int(num)
+    return mask
+
+def from_mask(mask):
+    '''
+    bitmask转换回从小到大排列的号码list。
+    '''
+    mask = int(mask)
+    return [str(i).zfill(2) for i in range(mask.bit_length()) if mask >> i & 1]
+
 def hit_check(numbers, winning_numbers):
     '''
     中奖号码匹配。
     '''
     log.info("Winning numbers are: ", winning_numbers)
-    red_win, blue_win = winning_numbers
+    red_win, blue_win = [to_mask(win) for win in winning_numbers]
     hits = []
     if numbers["game_type"] == "single" or numbers["game_type"] == "compound":
         for number in numbers["numbers"]:
             log.info("User numbers are: ", number)
             red, blue = number
-            red_hit = sorted(list(set(red) & set(red_win)), key=natsort_key)
-            blue_hit = sorted(list(set(blue) & set(blue_win)), key=natsort_key)
+            red_hit = from_mask(to_mask(red) & red_win)
+            blue_hit = from_mask(to_mask(blue) & blue_win)
             log.info("Hit numbers are: ", (red_hit, blue_hit))
             hits.append((red_hit, blue_hit))
     else:
         for number in numbers["numbers"]:
             log.info("User numbers are: ", number)
             red_required, red_optional, blue_required, blue_optional = number
-            red_required_hit = sorted(list(set(red_required) & set(red_win)), key=natsort_key)
-            red_optional_hit = sorted(list(set(red_optional) & set(red_win)), key=natsort_key)
-            blue_required_hit = sorted(list(set(blue_required) & set(blue_win)), key=natsort_key)
-            blue_optional_hit = sorted(list(set(blue_optional) & set(blue_win)), key=natsort_key)
+            red_required_hit = from_mask(to_mask(red_required) & red_win)
+            red_optional_hit = from_mask(to_mask(red_optional) & red_win)
+            blue_required_hit = from_mask(to_mask(blue_required) & blue_win)
+            blue_optional_hit = from_mask(to_mask(blue_optional) & blue_win)
             log.info("Hit numbers are: ", (red_required_hit, red_optional_hit, blue_required_hit, blue_optional_hit))
             hits.append((red_required_hit, red_optional_hit, blue_required_hit, blue_optional_hit))
     return hits
@@ -290,6 +312,20 @@ class Result:
     def toTuple(self):
         return self.code, self.issue, {"code": self.code, "game_type": self.game_type, "numbers": self.numbers}
 
+    @classmethod
+    def fromDict(self, d):
+        return Result(d["code"], d["issue"], d["game_type"], d["numbers"], d.get("winning"), d.get("hits"))
+
+    def toDict(self):
+        return {
+            "code": self.code,
+            "issue": self.issue,
+            "game_type": self.game_type,
+            "numbers": self.numbers,
+            "winning": self.winning,
+            "hits": self.hits
+        }
+
     def codeConvert(self, code):
         return "双色球" if code == "ssq" else "超级大乐透"
 